@@ -0,0 +1,8 @@
+""" Q2K benchmark suite
+
+Generates a synthetic qmk_firmware/keyboards tree and times cache generation, cold and warm single conversions and
+bulk conversion. Run with ``python -m q2k.bench -o results.json`` and compare runs with ``--compare old.json``.
+"""
+
+from q2k.bench.synthetic import SyntheticTree, generate_tree
+from q2k.bench.runner import Benchmark, compare, main
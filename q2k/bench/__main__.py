@@ -0,0 +1,3 @@
+from q2k.bench.runner import main
+
+main()
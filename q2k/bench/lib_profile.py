@@ -0,0 +1,100 @@
+""" Include stub profile checks - size of the preprocessed output, parsing time and identical conversions per profile """
+
+import argparse
+import contextlib
+import filecmp
+import io
+import os
+import sys
+import tempfile
+
+import q2k.core as core
+from q2k.bench.synthetic import SyntheticTree
+
+def convert(workdir, qmk_dir, profile, preprocessor='avr-gcc', bulk=0):
+    """ Convert every keymap of qmk_dir with an include stub profile, into <workdir>/<profile>
+
+    Returns the batch summary of Q2KApp.execute_batch (with timings).
+    """
+
+    core.Defaults.SRC = os.path.join(workdir, profile)
+    core.Defaults.CACHE = os.path.join(workdir, '.cache', 'cache_kb.yaml')
+    core.Defaults.QMK = qmk_dir
+    core.Defaults.KEYP = os.path.join(workdir, profile, 'keyplus')
+    core.Defaults.KBF = os.path.join(workdir, profile, 'kbfirmware')
+    os.makedirs(core.Defaults.SRC, exist_ok=True)
+
+    argv = sys.argv
+    sys.argv = argv[:1]
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            app = core.Q2KApp('keyplus', is_gui=True)
+        finally:
+            sys.argv = argv
+        app.console.batch = True
+        app.timings = True
+        app.preprocessor = core.Preprocessor.named(preprocessor)
+        app.lib_profile = profile
+        jobs = app.batch_jobs()
+        return app.execute_batch(jobs[:bulk] if bulk else jobs)
+
+def measure(summary):
+    """ Preprocessed characters, preprocessor seconds and parsing seconds (config.h and keymap.c stages less
+    preprocessing) of a batch summary
+    """
+
+    chars = preproc = parse = 0.0
+    for result in summary['results']:
+        report = result.get('timings')
+        if not report:
+            continue
+        chars += report['counts'].get('config_chars', 0) + report['counts'].get('keymap_chars', 0)
+        runs = sum(run['wall'] for run in report['preprocessor'])
+        preproc += runs
+        parse += sum(report['stages'].get(name, {}).get('wall', 0.0) for name in ('get_config_header', 'get_keycodes')) - runs
+    return {'jobs': summary['jobs'], 'ok': summary['ok'], 'chars': int(chars), 'preprocessor': preproc, 'parse': parse}
+
+def differ(workdir, old, new):
+    """ Output files which are missing or not identical between two profiles"""
+
+    old_dir, new_dir = os.path.join(workdir, old, 'keyplus'), os.path.join(workdir, new, 'keyplus')
+    names = set(os.listdir(old_dir) if os.path.isdir(old_dir) else []) | set(os.listdir(new_dir) if os.path.isdir(new_dir) else [])
+    return sorted(name for name in names if not (os.path.isfile(os.path.join(old_dir, name)) and os.path.isfile(os.path.join(new_dir, name))
+                                                 and filecmp.cmp(os.path.join(old_dir, name), os.path.join(new_dir, name), shallow=False)))
+
+def main(argv=None):
+    """ Command line entry point - python -m q2k.bench.lib_profile"""
+
+    parser = argparse.ArgumentParser(prog='python -m q2k.bench.lib_profile', description='Compare Q2K include stub profiles (--lib-profile)')
+    parser.add_argument('qmk', metavar='QMK_DIR', nargs='?', default='', help='QMK Firmware directory to convert - default is a synthetic tree')
+    parser.add_argument('--preprocessor', metavar='NAME', choices=['avr-gcc', 'cpp'], default='avr-gcc',
+                        help='Preprocessor backend: avr-gcc (default) or cpp (host preprocessor)')
+    parser.add_argument('--keyboards', type=int, default=20, help='Keyboards of the synthetic tree')
+    parser.add_argument('--bulk', type=int, default=0, help='Maximum conversion jobs per profile (0 for all)')
+    args = parser.parse_args(argv)
+
+    profiles = sorted(core.Defaults.LIB_PROFILES)
+    with tempfile.TemporaryDirectory(prefix='q2k-libs-') as workdir:
+        qmk_dir = args.qmk
+        if not qmk_dir:
+            qmk_dir = os.path.join(workdir, 'qmk_firmware')
+            SyntheticTree(args.keyboards, system_includes=True).write(qmk_dir)
+        results = {profile: measure(convert(workdir, qmk_dir, profile, args.preprocessor, args.bulk)) for profile in profiles}
+        changed = differ(workdir, profiles[0], profiles[-1])
+
+    print('{:<10} {:>6} {:>14} {:>14} {:>10}'.format('profile', 'ok', 'preprocessed', 'preprocessor', 'parsing'))
+    for profile in profiles:
+        res = results[profile]
+        print('{:<10} {:>6} {:>12}ch {:>13.3f}s {:>9.3f}s'.format(profile, '{}/{}'.format(res['ok'], res['jobs']), res['chars'],
+                                                                 res['preprocessor'], res['parse']))
+    first, last = results[profiles[0]], results[profiles[-1]]
+    if first['chars'] and first['parse']:
+        print('{} vs {}: {:.1f}% of the preprocessed output, parsing {:.1f}x faster'.format(
+            profiles[-1], profiles[0], 100.0 * last['chars'] / first['chars'], first['parse'] / last['parse'] if last['parse'] else 0.0))
+    for name in changed:
+        print('Output differs: ' + name)
+    print('{} outputs differ between {} and {}'.format(len(changed), profiles[0], profiles[-1]))
+    return 1 if changed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
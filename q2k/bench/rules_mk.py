@@ -0,0 +1,107 @@
+""" rules.mk MCU scanner checks - parity of the line scanner with the pyparsing grammar, and throughput of both """
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+from q2k.core import Defaults, _ParseTxt
+from q2k.bench.synthetic import SyntheticTree
+
+# rules.mk forms seen in QMK Firmware, with the MCU list the line scanner should find
+SAMPLES = [
+    ('plain',        'MCU = atmega32u4\nBOOTLOADER = atmel-dfu\n',                                    ['atmega32u4']),
+    ('comment',      '# MCU name\n#MCU = at90usb1286\nMCU = atmega32u4  # the mcu\n',                 ['atmega32u4']),
+    ('no spaces',    'MCU=atmega32u2\n',                                                               ['atmega32u2']),
+    ('conditional',  'ifeq ($(X), yes)\n  MCU = at90usb1286\nelse\n  MCU = atmega32u4\nendif\n',      ['at90usb1286', 'atmega32u4']),
+    ('default',      'MCU ?= atmega32u4\n',                                                            ['atmega32u4']),
+    ('immediate',    'MCU := STM32F303\n',                                                             ['STM32F303']),
+    ('other names',  'MCU_FAMILY = STM32\nMCU_SERIES = STM32F3xx\nMCU = STM32F303\n',                  ['STM32F303']),
+    ('no mcu',       '# Bootloader selection\nBOOTLOADER = caterina\n',                                []),
+]
+
+def read_grammar(path):
+    """ MCU list of a rules.mk from the pyparsing grammar (_ParseTxt.rules_mk_mcu)"""
+    with open(path, 'r', encoding='utf8') as f:
+        data = str(f.read())
+    return [tokens[0].mcu for tokens in _ParseTxt.rules_mk_mcu(data)]
+
+def read_lines(path):
+    """ MCU list of a rules.mk from the line scanner (_ParseTxt.rules_mk_mcu_lines)"""
+    with open(path, 'r', encoding='utf8') as f:
+        return _ParseTxt.rules_mk_mcu_lines(f)
+
+def corpus(qmk_dir):
+    """ Paths of every rules.mk in <qmk_dir>/keyboards"""
+    return sorted(glob.glob(os.path.join(qmk_dir, 'keyboards', '**', 'rules.mk'), recursive=True))
+
+def check_samples():
+    """ Samples for which the line scanner does not find the expected list, as (name, expected, found)"""
+    failed = []
+    for name, text, expected in SAMPLES:
+        found = _ParseTxt.rules_mk_mcu_lines(text.splitlines(True))
+        if found != expected:
+            failed.append((name, expected, found))
+    return failed
+
+def parity(paths):
+    """ Files for which the line scanner and the grammar disagree, as (path, grammar list, line scanner list)"""
+    differ = []
+    for path in paths:
+        try:
+            old, new = read_grammar(path), read_lines(path)
+        except (OSError, UnicodeDecodeError):
+            continue
+        if old != new:
+            differ.append((path, old, new))
+    return differ
+
+def throughput(paths, repeat=3):
+    """ Files per second read by the grammar and by the line scanner, best of repeat runs"""
+    results = {}
+    for name, read in (('grammar', read_grammar), ('lines', read_lines)):
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            for path in paths:
+                try:
+                    read(path)
+                except (OSError, UnicodeDecodeError):
+                    pass
+            wall = time.perf_counter() - start
+            best = wall if best is None else min(best, wall)
+        results[name] = len(paths) / best if best else 0.0
+    return results
+
+def main(argv=None):
+    """ Command line entry point - python -m q2k.bench.rules_mk"""
+
+    parser = argparse.ArgumentParser(prog='python -m q2k.bench.rules_mk', description='Check the rules.mk MCU line scanner against the pyparsing grammar')
+    parser.add_argument('qmk', metavar='QMK_DIR', nargs='?', default='', help='QMK Firmware directory to take rules.mk files from - default is Defaults.QMK, or a synthetic tree if it has none')
+    parser.add_argument('--repeat', type=int, default=3, help='Throughput runs (best is reported)')
+    args = parser.parse_args(argv)
+
+    failed = check_samples()
+    for name, expected, found in failed:
+        print('Sample {}: expected {}, found {}'.format(name, expected, found))
+
+    with tempfile.TemporaryDirectory(prefix='q2k-rules-') as workdir:
+        paths = corpus(args.qmk or Defaults.QMK)
+        if not paths:
+            SyntheticTree().write(workdir)
+            paths = corpus(workdir)
+        differ = parity(paths)
+        rates = throughput(paths, args.repeat)
+
+    for path, old, new in differ:
+        print('{}: grammar {}, line scanner {}'.format(path, old, new))
+    print('{} samples, {} failed'.format(len(SAMPLES), len(failed)))
+    print('{} rules.mk files, {} differ from the grammar'.format(len(paths), len(differ)))
+    print('{:<16} {:>10.0f} files/s'.format('grammar', rates['grammar']))
+    print('{:<16} {:>10.0f} files/s'.format('line scanner', rates['lines']))
+    return 1 if failed or differ else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+""" Q2K benchmark runner - times cache generation, single and bulk conversions against a synthetic QMK tree """
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import q2k.core as core
+from q2k.bench.synthetic import SyntheticTree
+
+class Benchmark:
+    """ A class for running the Q2K benchmark suite in an isolated work directory
+
+    Attributes:
+        workdir(str)      : Work directory holding the synthetic qmk_firmware tree, pref.yaml, cache and output
+        tree(SyntheticTree): Synthetic tree parameters
+        repeat(int)       : Number of warm conversion runs
+        bulk(int)         : Maximum number of jobs in the bulk conversion (0 for all)
+        avr_gcc(str)      : Compiler to preprocess with instead of Defaults.AVR_GCC (blank for the default)
+        preprocessor(str) : Preprocessor backend name - avr-gcc, cpp or replay (see core.Preprocessor.named)
+        replay_with(str)  : Backend recording the outputs replayed with the replay backend - avr-gcc or cpp
+        fast_scan(bool)   : Time a fast scan cache build (see core.Q2KApp.scan_cache) - conversions then scan on demand
+        lib_profile(str)  : Include stub profile to preprocess with (see core.Defaults.LIB_PROFILES)
+        quiet(bool)       : Discard Q2K console output while timing
+
+    With the replay backend, every conversion is run once untimed to record preprocessor output, so the timed runs
+    measure parsing and conversion only.
+    """
+
+    def __init__(self, workdir, tree, repeat=5, bulk=50, avr_gcc='', quiet=True, preprocessor='avr-gcc', fast_scan=False,
+                 lib_profile='full', replay_with='avr-gcc'):
+        self.workdir = os.path.abspath(workdir)
+        self.tree = tree
+        self.repeat = repeat
+        self.bulk = bulk
+        self.quiet = quiet
+        self.avr_gcc = avr_gcc
+        self.preprocessor = preprocessor
+        self.replay_with = replay_with
+        self.fast_scan = fast_scan
+        self.lib_profile = lib_profile
+        self.__backend = None
+
+    def __isolate(self):
+        """ Point Q2K's pref.yaml, cache, QMK and output directories into the work directory"""
+
+        core.Defaults.SRC = self.workdir
+        core.Defaults.CACHE = os.path.join(self.workdir, '.cache', 'cache_kb.yaml')
+        core.Defaults.QMK = os.path.join(self.workdir, 'qmk_firmware')
+        core.Defaults.KEYP = os.path.join(self.workdir, 'q2k_out', 'keyplus')
+        core.Defaults.KBF = os.path.join(self.workdir, 'q2k_out', 'kbfirmware')
+        if self.avr_gcc:
+            core.Defaults.AVR_GCC = self.avr_gcc
+
+    def __output(self):
+        if self.quiet:
+            return contextlib.redirect_stdout(io.StringIO())
+        return contextlib.ExitStack()
+
+    def __app(self):
+        """ Create a Q2KApp in library mode - no command line, no dialogs, no pauses"""
+
+        argv = sys.argv
+        sys.argv = argv[:1]
+        try:
+            app = core.Q2KApp('keyplus', is_gui=True)
+        finally:
+            sys.argv = argv
+        app.console.batch = True
+        app.timings = True
+        app.preprocessor = self.__backend
+        app.fast_scan = self.fast_scan
+        app.lib_profile = self.lib_profile
+        return app
+
+    def run(self):
+        """ Run all benchmarks and return the results as a JSON serialisable dictionary"""
+
+        self.__isolate()
+        self.__backend = core.Preprocessor.named(self.preprocessor, self.replay_with)
+        os.makedirs(self.workdir, exist_ok=True)
+        if os.path.isfile(os.path.join(self.workdir, 'pref.yaml')):
+            os.remove(os.path.join(self.workdir, 'pref.yaml'))
+        shutil.rmtree(os.path.join(self.workdir, '.cache'), ignore_errors=True)
+
+        results = {}
+
+        # Tree generation (not part of Q2K, but useful for sanity checking machine speed)
+        start = time.perf_counter()
+        self.tree.write(core.Defaults.QMK)
+        results['generate_tree'] = {'wall': time.perf_counter() - start}
+
+        # Cache generation
+        with self.__output():
+            app = self.__app()
+            start, cpu = time.perf_counter(), time.process_time()
+            app.refresh_cache()
+            results['cache_build'] = {'wall': time.perf_counter() - start, 'cpu': time.process_time() - cpu,
+                                      'keyboards': len(app.keyboard_list())}
+
+        jobs = app.batch_jobs()
+        if not jobs:
+            raise RuntimeError('Synthetic tree produced no conversion jobs')
+        job = jobs[0]
+        bulk_jobs = jobs[:self.bulk] if self.bulk else jobs
+
+        if self.preprocessor == 'replay':
+            with self.__output():
+                app.execute_batch(bulk_jobs)
+
+        # Cold single conversion - new application (reading pref.yaml and cache_kb.yaml from disk), first conversion
+        with self.__output():
+            start = time.perf_counter()
+            app = self.__app()
+            init = time.perf_counter() - start
+            app.set_kb(*job)
+            report = app.execute()
+            results['cold_conversion'] = {'job': list(job), 'init_wall': init, 'wall': time.perf_counter() - start,
+                                          'timings': report}
+
+        # Warm single conversion - same application, same keyboard, repeated
+        walls = []
+        reports = []
+        with self.__output():
+            for i in range(self.repeat):
+                start = time.perf_counter()
+                app.set_kb(*job)
+                reports.append(app.execute())
+                walls.append(time.perf_counter() - start)
+        results['warm_conversion'] = {'job': list(job), 'runs': len(walls), 'wall': self.__stats(walls),
+                                      'stages': core._Timings.aggregate(reports)}
+
+        # Bulk conversion
+        with self.__output():
+            start, cpu = time.perf_counter(), time.process_time()
+            summary = app.execute_batch(bulk_jobs)
+            wall = time.perf_counter() - start
+        results['bulk_conversion'] = {
+            'jobs'           : summary['jobs'],
+            'ok'             : summary['ok'],
+            'failed'         : summary['failed'],
+            'wall'           : wall,
+            'cpu'            : time.process_time() - cpu,
+            'jobs_per_second': summary['jobs'] / wall if wall else 0.0,
+            'stages'         : summary['timings'],
+        }
+
+        return {
+            'q2k_version' : core.Defaults.VERSION,
+            'commit'      : self.__commit(),
+            'python'      : platform.python_version(),
+            'platform'    : platform.platform(),
+            'timestamp'   : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'preprocessor': self.preprocessor,
+            'fast_scan'   : self.fast_scan,
+            'lib_profile' : self.lib_profile,
+            'tree'        : self.tree.params(),
+            'results'     : results,
+        }
+
+    def __stats(self, values):
+        return {
+            'mean' : sum(values) / len(values) if values else 0.0,
+            'p50'  : core._Timings.percentile(values, 50),
+            'p90'  : core._Timings.percentile(values, 90),
+            'min'  : min(values) if values else 0.0,
+            'max'  : max(values) if values else 0.0,
+        }
+
+    def __commit(self):
+        """ git commit of the Q2K source being benchmarked, if available"""
+        try:
+            src = os.path.dirname(os.path.abspath(core.__file__))
+            output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=src, stderr=subprocess.DEVNULL)
+            return output.decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+
+def headline(results):
+    """ The main figures of a benchmark result, as {name: seconds}"""
+    res = results['results']
+    return {
+        'cache_build'     : res['cache_build']['wall'],
+        'cold_conversion' : res['cold_conversion']['wall'],
+        'warm_conversion' : res['warm_conversion']['wall']['p50'],
+        'bulk_conversion' : res['bulk_conversion']['wall'],
+        'bulk_per_job'    : res['bulk_conversion']['wall'] / max(res['bulk_conversion']['jobs'], 1),
+    }
+
+def compare(old, new):
+    """ Lines comparing the headline figures of two benchmark results"""
+    lines = []
+    old_h, new_h = headline(old), headline(new)
+    for name, secs in new_h.items():
+        before = old_h.get(name)
+        if before:
+            change = 100.0 * (secs - before) / before
+            lines.append('{:<16} {:>9.4f}s -> {:>9.4f}s  {:+.1f}%'.format(name, before, secs, change))
+        else:
+            lines.append('{:<16} {:>9.4f}s'.format(name, secs))
+    return lines
+
+def main(argv=None):
+    """ Command line entry point - python -m q2k.bench"""
+
+    defaults = SyntheticTree()
+    parser = argparse.ArgumentParser(prog='python -m q2k.bench', description='Benchmark Q2K against a synthetic QMK Firmware tree')
+    parser.add_argument('-o', '--output', metavar='FILE', default='', help='Write results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', default='', help='Compare results with an earlier JSON result file')
+    parser.add_argument('--workdir', metavar='DIR', default='', help='Work directory - default is a temporary directory')
+    parser.add_argument('--avr-gcc', metavar='CC', dest='avr_gcc', default='', help='Preprocessor compiler to use instead of Defaults.AVR_GCC')
+    parser.add_argument('--preprocessor', metavar='NAME', choices=['avr-gcc', 'cpp', 'replay'], default='avr-gcc',
+                        help='Preprocessor backend: avr-gcc (default), cpp (host preprocessor) or replay (record once, then time parsing and conversion only)')
+    parser.add_argument('--replay-with', metavar='NAME', dest='replay_with', choices=['avr-gcc', 'cpp'], default='avr-gcc',
+                        help='With --preprocessor replay, record outputs with avr-gcc (default) or cpp')
+    parser.add_argument('--fast-scan', dest='fast_scan', action='store_true', help='Time a fast scan cache build (keyboards are validated when first converted)')
+    parser.add_argument('--lib-profile', metavar='NAME', dest='lib_profile', choices=sorted(core.Defaults.LIB_PROFILES), default='full',
+                        help='Include stubs to preprocess with: full (default) or keymap (keymap-only stubs, also for common system headers)')
+    parser.add_argument('--system-includes', dest='system_includes', action='store_true', help='Include C library headers in synthetic keyboard headers and keymaps')
+    parser.add_argument('--keyboards', type=int, default=defaults.keyboards, help='Number of keyboards')
+    parser.add_argument('--revisions', type=int, default=defaults.revisions, help='Revisions per keyboard')
+    parser.add_argument('--vendors', type=float, default=defaults.vendors, help='Fraction of keyboards in vendor directories')
+    parser.add_argument('--keymaps', type=int, default=defaults.keymaps, help='Keymaps per keyboard')
+    parser.add_argument('--rows', type=int, default=defaults.rows, help='Matrix rows')
+    parser.add_argument('--cols', type=int, default=defaults.cols, help='Matrix columns')
+    parser.add_argument('--templates', type=int, default=defaults.templates, help='LAYOUT templates per keyboard header')
+    parser.add_argument('--layers', type=int, default=defaults.layers, help='Layers per keymap')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='Random seed')
+    parser.add_argument('--repeat', type=int, default=5, help='Warm conversion runs')
+    parser.add_argument('--bulk', type=int, default=50, help='Maximum bulk conversion jobs (0 for all) - default is 50')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show Q2K console output')
+    args = parser.parse_args(argv)
+
+    tree = SyntheticTree(args.keyboards, args.revisions, args.vendors, args.keymaps, args.rows, args.cols,
+                         args.templates, args.layers, seed=args.seed,
+                         system_includes=args.system_includes)
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory(prefix='q2k-bench-'))
+        bench = Benchmark(workdir, tree, args.repeat, args.bulk, args.avr_gcc, quiet=not args.verbose, preprocessor=args.preprocessor,
+                          fast_scan=args.fast_scan, lib_profile=args.lib_profile,
+                          replay_with=args.replay_with)
+        results = bench.run()
+
+    for name, secs in headline(results).items():
+        print('{:<16} {:>9.4f}s'.format(name, secs))
+    bulk = results['results']['bulk_conversion']
+    print('{:<16} {} ok, {} failed'.format('bulk_jobs', bulk['ok'], bulk['failed']))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+        print('Compared with ' + args.compare + ' (' + (old.get('commit') or 'unknown commit') + ')')
+        for line in compare(old, results):
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results written to ' + args.output)
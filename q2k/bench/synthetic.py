@@ -0,0 +1,178 @@
+""" Synthetic QMK Firmware tree generator for Q2K benchmarks (no network access required) """
+
+import os
+import random
+
+from q2k.core import Defaults
+from q2k.reference import Q2KRef
+
+# Pins used for MATRIX_ROW_PINS / MATRIX_COL_PINS
+PINS = ['B0', 'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'C6', 'C7', 'D0', 'D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7',
+        'E6', 'F0', 'F1', 'F4', 'F5', 'F6', 'F7']
+
+# Keycodes keyplus does not support - sprinkled into keymaps so the invalid keycode paths get exercised
+INVALID_KC = ['RGB_TOG', 'RGB_MOD', 'BL_STEP', 'AU_TOG', 'MU_TOG', 'KC_FAKE']
+
+class SyntheticTree:
+    """ A class describing and writing a synthetic qmk_firmware/keyboards tree
+
+    Attributes:
+        keyboards(int)  : Number of keyboards
+        revisions(int)  : Revision depth - revisions per keyboard (0 for keyboards without revisions)
+        vendors(float)  : Fraction of keyboards placed in vendor directories (Defaults.QMK_NONSTD_DIR)
+        keymaps(int)    : Keymaps per keyboard (the first is always named default)
+        rows(int)       : Matrix rows of each keyboard
+        cols(int)       : Matrix columns of each keyboard
+        templates(int)  : LAYOUT templates per <keyboard>.h header
+        layers(int)     : Layers per keymap
+        invalid(float)  : Fraction of keycodes which are not supported by keyplus
+        seed(int)       : Random seed - the same parameters and seed always produce the same tree
+        system_includes(bool): Include C library headers (stdint.h, stdio.h, ...) in keyboard headers and keymaps, as
+                               many QMK keyboards do
+    """
+
+    def __init__(self, keyboards=50, revisions=2, vendors=0.2, keymaps=3, rows=5, cols=15, templates=3, layers=3,
+                 invalid=0.02, seed=0, system_includes=False):
+        self.keyboards = keyboards
+        self.revisions = revisions
+        self.vendors = vendors
+        self.keymaps = keymaps
+        self.rows = rows
+        self.cols = cols
+        self.templates = templates
+        self.layers = layers
+        self.invalid = invalid
+        self.seed = seed
+        self.system_includes = system_includes
+
+    def params(self):
+        """ Parameters of this tree as a dictionary"""
+        return dict(vars(self))
+
+    def write(self, qmk_dir):
+        """ Write the tree to <qmk_dir>/keyboards and return the list of keyboard names"""
+
+        rand = random.Random(self.seed)
+        qdir = os.path.join(qmk_dir, 'keyboards')
+        kb_names = []
+
+        for i in range(self.keyboards):
+            kb_n = 'synth' + str(i)
+            if rand.random() < self.vendors:
+                kb_n = '/'.join([rand.choice(Defaults.QMK_NONSTD_DIR), kb_n])
+            kb_names.append(kb_n)
+            kb_dir = os.path.join(qdir, *kb_n.split('/'))
+
+            self.__write_file(os.path.join(kb_dir, 'rules.mk'), self.__rules_mk())
+            self.__write_file(os.path.join(kb_dir, 'config.h'), self.__config_h(rand))
+            self.__write_file(os.path.join(kb_dir, kb_n.split('/')[-1]+'.h'), self.__keyboard_h())
+
+            for j in range(self.revisions):
+                rev_n = 'rev' + str(j+1)
+                rev_dir = os.path.join(kb_dir, rev_n)
+                self.__write_file(os.path.join(rev_dir, 'rules.mk'), '# Revision '+rev_n+'\nBOOTLOADER = atmel-dfu\n')
+                self.__write_file(os.path.join(rev_dir, 'config.h'), '#pragma once\n#include "config_common.h"\n#define DEVICE_VER 0x000'+str(j+1)+'\n')
+                self.__write_file(os.path.join(rev_dir, rev_n+'.h'), '#pragma once\n#include "'+kb_n.split('/')[-1]+'.h"\n')
+
+            for k in range(self.keymaps):
+                km_n = 'default' if k == 0 else 'user' + str(k)
+                self.__write_file(os.path.join(kb_dir, 'keymaps', km_n, 'keymap.c'), self.__keymap_c(rand, kb_n))
+
+        return kb_names
+
+    def __write_file(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(text)
+
+    def __rules_mk(self):
+        return '\n'.join([
+            '# MCU name',
+            'MCU = atmega32u4',
+            '',
+            '# Bootloader selection',
+            'BOOTLOADER = atmel-dfu',
+            '',
+            'BOOTMAGIC_ENABLE = no   # Virtual DIP switch configuration',
+            'MOUSEKEY_ENABLE = yes   # Mouse keys',
+            'EXTRAKEY_ENABLE = yes   # Audio control and System control',
+            'NKRO_ENABLE = no        # USB Nkey Rollover',
+            '',
+        ])
+
+    def __config_h(self, rand):
+        pins = list(PINS)
+        rand.shuffle(pins)
+        rows = pins[:self.rows]
+        cols = pins[self.rows:self.rows+self.cols]
+        return '\n'.join([
+            '#pragma once',
+            '#include "config_common.h"',
+            '',
+            '#define VENDOR_ID       0xFEED',
+            '#define PRODUCT_ID      0x6060',
+            '#define MATRIX_ROWS ' + str(self.rows),
+            '#define MATRIX_COLS ' + str(len(cols)),
+            '#define MATRIX_ROW_PINS { ' + ', '.join(rows) + ' }',
+            '#define MATRIX_COL_PINS { ' + ', '.join(cols) + ' }',
+            '#define DIODE_DIRECTION ' + rand.choice(['COL2ROW', 'ROW2COL']),
+            '#define DEBOUNCE 5',
+            '',
+        ])
+
+    def __keyboard_h(self):
+        cols = min(self.cols, len(PINS) - self.rows)
+        keys = [['K'+format(r, 'X')+format(c, 'X') for c in range(cols)] for r in range(self.rows)]
+        lines = ['#pragma once', '#include "quantum.h"', '']
+        if self.system_includes:
+            lines[2:2] = ['#include <stdint.h>', '#include <stdbool.h>']
+        for t in range(self.templates):
+            name = 'LAYOUT' if t == 0 else 'LAYOUT_' + str(t)
+            lines.append('#define ' + name + '( \\')
+            for r, row in enumerate(keys):
+                lines.append('    ' + ', '.join(row) + (', \\' if r+1 < len(keys) else '  \\'))
+            lines.append(') { \\')
+            for r, row in enumerate(keys):
+                lines.append('    { ' + ', '.join(row) + (' }, \\' if r+1 < len(keys) else ' }  \\'))
+            lines.append('}')
+            lines.append('')
+        return '\n'.join(lines)
+
+    def __keymap_c(self, rand, kb_n):
+        cols = min(self.cols, len(PINS) - self.rows)
+        keycodes = sorted(Q2KRef.keyp_kc.keys())
+        layer_names = ['_L'+str(i) for i in range(self.layers)]
+
+        lines = ['#include "'+kb_n.split('/')[-1]+'.h"', '']
+        if self.system_includes:
+            lines += ['#include <stdio.h>', '#include <stdlib.h>', '#include <string.h>', '']
+        lines += ['enum layers { ' + ', '.join(layer_names) + ' };', '',
+                  'const uint16_t PROGMEM keymaps[][MATRIX_ROWS][MATRIX_COLS] = {']
+        for l, layer_n in enumerate(layer_names):
+            lines.append('  /* Layer ' + str(l) + ' */')
+            lines.append('  [' + layer_n + '] = LAYOUT(')
+            for r in range(self.rows):
+                row = []
+                for c in range(cols):
+                    roll = rand.random()
+                    if roll < self.invalid:
+                        row.append(rand.choice(INVALID_KC))
+                    elif roll < self.invalid + 0.03 and self.layers > 1:
+                        row.append('MO(' + layer_names[(l+1) % self.layers] + ')')
+                    elif roll < self.invalid + 0.05 and self.layers > 1:
+                        row.append('LT(' + layer_names[(l+1) % self.layers] + ', KC_SPC)')
+                    else:
+                        row.append(rand.choice(keycodes))
+                last = r+1 == self.rows
+                lines.append('    ' + ', '.join(row) + ('' if last else ','))
+            lines.append('  )' + (',' if l+1 < self.layers else ''))
+        lines.append('};')
+        lines.append('')
+        return '\n'.join(lines)
+
+def generate_tree(qmk_dir, **params):
+    """ Write a synthetic QMK tree into qmk_dir. Keyword arguments are SyntheticTree attributes. Returns the SyntheticTree"""
+
+    tree = SyntheticTree(**params)
+    tree.write(qmk_dir)
+    return tree
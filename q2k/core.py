@@ -1,20 +1,38 @@
+import abc
 import argparse
+import cProfile
 import copy
 import errno
 import enum as en
 import glob
+import gzip
+import hashlib
+import json
 import os
 import pathlib
 import platform
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import tracemalloc
 import tkinter as tk
 import pyparsing as pp
 import termcolor as tc
 import yaml
 
+try:
+    import fcntl                                               # File locks (POSIX)
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt                                              # File locks (Windows)
+except ImportError:
+    msvcrt = None
+
 from q2k.reference import Q2KRef
 from q2k.version import Q2K_VERSION
 """ Q2K Keymap Utility - For converting from QMK Firmware keymaps to keyplus layout format """
@@ -28,12 +46,18 @@ class Defaults:
 
         SRC(str)        : Path to source directory of this application
         LIBS(str)       : Path to local libs directory
-        CACHE(str)      : Path to cache yaml
+        LIB_PROFILES(dict): Include stub profiles - name -> folder of stubs in the local libs directory searched first, also
+                            ahead of the compiler's system headers ('' to use the local libs directory as it is)
+        CACHE(str)      : Path to cache yaml - caches of each QMK checkout are kept in its folder (see _CacheNamespace)
         QMK(str)        : Path to qmk directory
         KEYP(str)       : Path to keyplus yaml output directory
         KBF(str)        : Path to kbfirmware json output directory
         AVR_GCC(str)    : Path to avr-gcc compiler dependency
+        HOST_CPP(str)   : Host C preprocessor - stand-in for avr-gcc (--preprocessor cpp)
         INVALID_KC(str) : What to replace invalid QMK keycodes with
+        BAD_KC_PRINT(int) : Distinct invalid keycodes printed to console per conversion (the rest are summarized)
+        BAD_KC_REPORT(int): Distinct invalid keycodes listed in the output file header per conversion
+        CACHE_LIMIT(int): Cached keyboard lists kept (one per QMK checkout and commit) before the least recently used are removed
         PRINT_LINES(str): Cosmetic element for console output
 
         QMK_NONSTD_DIR(:obj:`list` of :obj:`str`) : List of non-standard QMK keyboard folders
@@ -52,6 +76,7 @@ class Defaults:
     # Directories
     LIBS = os.path.join(SRC, 'lib')                            # Local Libs                                              Default is $Q2K/libs/
     CACHE = os.path.join(SRC, '.cache', 'cache_kb.yaml')       # Cache                                                   Default is $Q2K/.cache/cache_kb.yaml
+    LIB_PROFILES = {'full': '', 'keymap': 'keymap_only'}       # Include stubs (--lib-profile)                           Default is full
 
     if FROZEN:
         QMK = os.path.join(SRC, 'qmk_firmware')                # QMK Directory - To be provided by user                  Default is $Q2K/qmk_firmware/
@@ -66,6 +91,7 @@ class Defaults:
         AVR_GCC = 'avr-gcc'                                    # avr-gcc for linux                                       Default is avr-gcc (Linux)
     elif platform.system() == 'Windows':
         AVR_GCC = os.path.join(SRC, 'avr-gcc', 'bin', 'avr-gcc.exe') # avr-gcc.exe for Windows
+    HOST_CPP = 'cpp'                                           # Host preprocessor, for machines without avr-gcc
     # Lists
     QMK_NONSTD_DIR = ['handwired', 'converter', 'clueboard', 'lfkeyboards'] # Right now only lfkeyboards causes any issues, however it is good to be verbose here
     #MCU_COMPAT = ['atmega32u2', 'atmega32u4', 'at90usb1286']
@@ -74,6 +100,9 @@ class Defaults:
 
     # Misc
     INVALID_KC = 'trns'                                       # What to set invalid KC codes to
+    BAD_KC_PRINT = 10                                         # Distinct invalid keycodes printed per conversion
+    BAD_KC_REPORT = 50                                        # Distinct invalid keycodes listed in output file headers
+    CACHE_LIMIT = 8                                           # Cached keyboard lists kept side by side
 
     if platform.system() == 'Linux':
         PRINT_LINES = '────────────────────────────────────────────────────────────────────────'
@@ -84,18 +113,72 @@ class _Console:
     """ A private class for handling output to application console
 
     Attributes:
-        gui(bool)    : Flag for GUIs (True if GUI, False otherwise)
-        errors(list) : List of printed errors
+        gui(bool)         : Flag for GUIs (True if GUI, False otherwise)
+        batch(bool)       : Flag for batch conversions - fatal errors raise RuntimeError instead of exiting and warnings never pause
+        format(str)       : Output format - text, or jsonl for one JSON object per message, without colors (warnings never pause)
+        errors(list)      : List of printed errors
+        diagnostics(list) : Diagnostic records of every invalid keycode occurrence (not included in errors)
+        kc_location(tuple): (layer, position) of the keycode being converted, for diagnostics
+        job(dict)         : keyboard, rev, keymap and template of the running single conversion (None if there is none) -
+                            reported as a failed result (jsonl format) if a fatal error ends it
+        dialog(function)  : GUI dialog hook - dialog(kind, title, message) where kind is 'error' or 'askyesno'.
+                            Lets GUIs running Q2K on a worker thread show message boxes on the Tk main thread.
     """
 
     def __init__(self, gui):
         """Class constructor"""
         self.gui = gui
+        self.batch = False
+        self.format = 'text'
         self.errors = []
+        self.diagnostics = []
+        self.kc_location = ('', -1)
+        self.job = None
+        self.dialog = None
+        self.__bad_kc_counts = {}
+        self.__progress_line = False
+
+    def __dialog(self, kind, title, message):
+        """ Shows a GUI message box, through the dialog hook if one is set"""
+        if self.dialog:
+            return self.dialog(kind, title, message)
+        if kind == 'error':
+            return tk.messagebox.showerror(title, message)
+        return tk.messagebox.askyesno(title, message)
+
+    def __emit(self, record_type, info=None, fields=None):
+        """ Prints a message as a single JSON object (jsonl format). Cosmetic PRINT_LINES are left out"""
+        record = {'type': record_type}
+        if info is not None:
+            info = [line for line in info if line != Defaults.PRINT_LINES]
+            if not info:
+                return
+            record['message'] = info[0]
+            record['details'] = info[1:]
+        if fields:
+            record.update(fields)
+        print(json.dumps(record), flush=True)
+
+    def __end_progress(self):
+        """ Clears an unfinished progress line so the next message starts on a fresh line"""
+        if self.__progress_line:
+            self.__progress_line = False
+            print('\r\x1b[K', end='')
 
     def error(self, info, fatal=True):
         """ Prints non-fatal and fatal error messages to console"""
-        if self.gui:
+        self.__end_progress()
+        if self.format == 'jsonl':
+            self.errors += info
+            self.__emit('error', info, {'fatal': fatal})
+            if fatal:
+                if self.batch:
+                    raise RuntimeError(info[0])
+                if self.job is not None:
+                    self.__emit('result', fields=dict(self.job, status='failed', ok=False, error=info[0], output='',
+                                                      invalid_keycodes=len(self.diagnostics)))
+                exit()
+        elif self.gui:
             msg = []
             for ind, line in enumerate(info):
                 msg += [line, ' \n']
@@ -108,7 +191,8 @@ class _Console:
                     print('•', line)
             msg = ''.join(msg)
             if fatal:
-                tk.messagebox.showerror('Error', msg)
+                if not self.batch:
+                    self.__dialog('error', 'Error', msg)
                 raise RuntimeError(warning)
         else:
             error_msg = tc.colored('❌ ERROR:', 'red', attrs=['reverse', 'bold'])
@@ -123,41 +207,91 @@ class _Console:
                     self.errors.append(line)
                     print(e_bullet, line)
             if fatal:
+                if self.batch:
+                    raise RuntimeError(info[0])
                 exit()
 
     def bad_kc(self, kc_type, code):
-        """ Prints bad keycode warnings to console"""
+        """ Records an invalid keycode, printing a bad keycode warning to console for the first occurrence of each code
+
+        At most Defaults.BAD_KC_PRINT distinct codes are printed per conversion - see summarize_bad_kc()
+        """
+        layer, position = self.kc_location
+        self.diagnostics.append(Diagnostic(kc_type, code, Defaults.INVALID_KC, layer, position))
+        key = (kc_type, code)
+        if key in self.__bad_kc_counts:
+            self.__bad_kc_counts[key] += 1
+            return
+        self.__bad_kc_counts[key] = 1
+        if self.format == 'jsonl':
+            self.__emit('bad_kc', fields=self.diagnostics[-1].as_dict())
+            return
+        if len(self.__bad_kc_counts) > Defaults.BAD_KC_PRINT:
+            return
+
+        self.__end_progress()
+        kc_err_out = ''.join(['[', code, '] - set to ', Defaults.INVALID_KC])
         if self.gui:
-            bad_kc_msg = ['❌ ', 'Invalid ', kc_type, ': ', code]
+            bad_kc_msg = ['❌ ', 'Invalid ', kc_type, ': ', kc_err_out]
             print(''.join(bad_kc_msg))
-            del bad_kc_msg[0]
-            self.errors.append(''.join(bad_kc_msg))
         else:
             message = ['❌ ', 'Invalid ', kc_type, ':']
             bad_kc_msg = [tc.colored(''.join(message), 'cyan')]
-            bad_kc_msg += [' ', code]
+            bad_kc_msg += [' ', kc_err_out]
             print(''.join(bad_kc_msg))
-            message += [' ', code]
-            self.errors.append(''.join(message))
 
-    def warning(self, info, pause=False):
-        """ Prints warnings and interactive warnings to console"""
+    def bad_kc_lines(self, limit=0):
+        """ Invalid keycodes aggregated into one line per distinct code with its number of occurrences
 
-        if self.gui:
+        Args:
+            limit(int) : Maximum number of distinct codes listed (0 for all). The last line counts any codes left out
+        """
+        lines = []
+        for (kc_type, code), count in self.__bad_kc_counts.items():
+            if limit and len(lines) >= limit:
+                lines.append(''.join(['... ', str(len(self.__bad_kc_counts) - limit), ' more invalid keycodes']))
+                break
+            line = ['Invalid ', kc_type, ': [', code, '] - set to ', Defaults.INVALID_KC]
+            if count > 1:
+                line += [' (x', str(count), ')']
+            lines.append(''.join(line))
+        return lines
+
+    def summarize_bad_kc(self):
+        """ Prints a summary of invalid keycodes if some were not printed individually"""
+        hidden = len(self.__bad_kc_counts) - Defaults.BAD_KC_PRINT
+        if hidden > 0 and self.format != 'jsonl':
+            # Console only - output files list bad_kc_lines() instead
+            self.warning([''.join([str(len(self.diagnostics)), ' invalid keycodes (', str(len(self.__bad_kc_counts)), ' distinct)']),
+                          ''.join([str(hidden), ' more distinct invalid keycodes not shown'])], record=False)
+
+    def warning(self, info, pause=False, record=True):
+        """ Prints warnings and interactive warnings to console
+
+        Args:
+            record(bool): Add the warning to errors (listed at the top of the output file)
+        """
+
+        errors = self.errors if record else []
+        self.__end_progress()
+        if self.format == 'jsonl':
+            errors += info
+            self.__emit('warning', info)
+        elif self.gui:
             msg = []
             for ind, line in enumerate(info):
                 msg += [line, ' \n']
                 if ind == 0:
                     warning = line
-                    self.errors.append(line)
+                    errors.append(line)
                     print('▲ WARNING:', line)
                 else:
-                    self.errors.append(line)
+                    errors.append(line)
                     print('•', line)
             msg = ''.join(msg)
-            if pause:
+            if pause and not self.batch:
                 pause_out = ''.join([msg, '\nContinue?'])
-                if not tk.messagebox.askyesno('Warning', pause_out):
+                if not self.__dialog('askyesno', 'Warning', pause_out):
                     raise RuntimeWarning(warning)
 
         else:
@@ -166,20 +300,23 @@ class _Console:
 
             for ind, line in enumerate(info):
                 if ind == 0:
-                    self.errors.append(line)
+                    errors.append(line)
                     line = tc.colored(line, 'yellow')
                     print(warning_msg, line)
                 else:
-                    self.errors.append(line)
+                    errors.append(line)
                     print(w_bullet, line)
-            if pause:
+            if pause and not self.batch:
                 print(w_bullet, 'Press [ENTER] to continue')
                 input()
 
 
     def note(self, info):
         """ Prints progress and success notification to console"""
-        if self.gui:
+        self.__end_progress()
+        if self.format == 'jsonl':
+            self.__emit('note', info)
+        elif self.gui:
             for ind, line in enumerate(info):
                 if ind == 0:
                     print('✔', line)
@@ -195,9 +332,104 @@ class _Console:
                 else:
                     print(n_bullet, line)
 
+    def progress(self, event):
+        """ Prints a CacheProgress event as a single, updating progress line (terminals) or one line per finished phase"""
+        finished = event.phase == 'done' or (event.total and event.done == event.total)
+        if self.format == 'jsonl':
+            self.__emit('progress', fields={'phase': event.phase, 'done': event.done, 'total': event.total, 'elapsed': event.elapsed, 'eta': event.eta})
+        elif not self.gui and sys.stdout.isatty():
+            if event.phase == 'done':
+                self.__end_progress()
+                return
+            line = tc.colored('…', 'green', attrs=['bold'])+' '+event.describe()
+            print('\r\x1b[K'+line, end='', flush=True)
+            self.__progress_line = True
+        elif finished and event.phase != 'done':
+            print('…', event.describe())
+
+    def result(self, kind, record):
+        """ Prints a result dictionary - conversion result, batch summary or timing report (jsonl format only, text output uses note)"""
+        if self.format == 'jsonl':
+            self.__emit(kind, fields=record)
+
     def clear(self):
 
         self.errors = []
+        self.diagnostics = []
+        self.kc_location = ('', -1)
+        self.__bad_kc_counts = {}
+
+class _MessageLog:
+    """ A private class standing in for _Console where messages must not be printed or added to a conversion's errors,
+    i.e. for background cache scans. Warnings and errors are collected in messages (lists of lines) instead; errors
+    never end the program
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def warning(self, info, pause=False, record=True):
+        self.messages.append(list(info))
+
+    def error(self, info, fatal=True):
+        self.messages.append(list(info))
+
+    def note(self, info):
+        pass
+
+class Diagnostic:
+    """" A container class for structured conversion diagnostics (invalid keycodes)"""
+
+    def __init__(self, kind='', code='', replacement='', layer='', position=-1):
+
+        self.kind = kind                 # KC (keycode) or FN (function)
+        self.code = code                 # QMK keycode or function as written in the keymap
+        self.replacement = replacement   # What the keycode was replaced with
+        self.layer = layer               # Name of the keycode layer
+        self.position = position         # Index of the key in the layer (in keymap order)
+
+    def as_dict(self):
+        """ This diagnostic as a JSON serialisable dictionary"""
+        return {'kind': self.kind, 'code': self.code, 'replacement': self.replacement, 'layer': self.layer, 'position': self.position}
+
+class Q2KCancelled(RuntimeError):
+    """ Raised inside a running cache generation or conversion after Q2KApp.cancel() is called"""
+
+class CacheProgress:
+    """" A container class for cache generation progress events
+
+    Attributes:
+        PHASES(dict) : Cache generation phases (in order) and their descriptions
+    """
+
+    PHASES = {
+        'discover'  : 'Discovering keyboard directories',
+        'validate'  : 'Validating revisions',
+        'templates' : 'Parsing layout templates',
+        'keymaps'   : 'Attaching keymaps',
+        'save'      : 'Saving cache',
+        'done'      : 'Done',
+    }
+
+    def __init__(self, phase, done=0, total=0, elapsed=0.0, eta=None, timings=None):
+
+        self.phase = phase           # Current phase - one of PHASES
+        self.done = done             # Items processed so far in this phase
+        self.total = total           # Items to process in this phase (0 if not known in advance)
+        self.elapsed = elapsed       # Seconds spent in this phase so far
+        self.eta = eta               # Estimated seconds left in this phase (None if unknown)
+        self.timings = timings or {} # Seconds spent in each finished phase
+
+    def describe(self):
+        """ Human readable one line summary of this event"""
+        text = [self.PHASES[self.phase]]
+        if self.total:
+            text.append(''.join(['[ ', str(self.done), '/', str(self.total), ' ] ', str(100*self.done//self.total), '%']))
+        elif self.done:
+            text.append(''.join(['[ ', str(self.done), ' ]']))
+        if self.eta is not None and self.done != self.total:
+            text.append('ETA '+str(int(self.eta+0.5))+'s')
+        return ' '.join(text)
 
 class _ParseTxt:
     """" A private class containing functions for handling text parsing (with pyparsing) of QMK source files"""
@@ -205,8 +437,6 @@ class _ParseTxt:
     def layout_headers(data):
         """ Finds LAYOUT templates from QMK <keyboard>.h header"""
 
-        data = str(data.replace('\\n', ' ').replace('\\r', ' ').replace('\\t', ' '))
-
         lparen, rparen, lbrac, rbrac, comma, bslash = map(pp.Suppress, "(){},\\")
 
         define = pp.Suppress(pp.Literal('#define'))
@@ -237,39 +467,29 @@ class _ParseTxt:
         return hresults
 
     def config_headers(data):
-        """ Finds matrix column and row pins from QMK config.h header"""
+        """ Finds matrix column and row pins from QMK config.h header (preprocessed with -dD)
 
-        data = str(data.replace('\\n', ' ').replace('\\r', ' ').replace('\\t', ' '))
+        A single pass over the text, stopping only at #defines of MATRIX_ROW_PINS, MATRIX_COL_PINS and DIODE_DIRECTION -
+        the other macros of the dump (i.e. from every included header) are skipped without being parsed.
+        """
 
         matrix_data = []
         matrix_row_pins = []
         matrix_col_pins = []
         matrix_diode_dir = []
 
-        lbrac, rbrac, comma = map(pp.Suppress, "{},")
-        define_rows = pp.Suppress(pp.Literal('define MATRIX_ROW_PINS'))
-        define_cols = pp.Suppress(pp.Literal('define MATRIX_COL_PINS'))
-        define_diodes = pp.Suppress(pp.Literal('define DIODE_DIRECTION'))
-
-        pincode = pp.Word(pp.alphanums) | pp.Word(pp.nums)
-        diode_var = pp.Word(pp.alphanums+'_')
-
-        matrix_rows = define_rows + lbrac + pp.ZeroOrMore(pincode + pp.Optional(comma)) + rbrac
-        matrix_rows.ignore(pp.cppStyleComment)
-        matrix_cols = define_cols + lbrac + pp.ZeroOrMore(pincode + pp.Optional(comma)) + rbrac
-        matrix_cols.ignore(pp.cppStyleComment)
-        matrix_diodes = define_diodes + diode_var('diodes')
-        matrix_diodes.ignore(pp.cppStyleComment)
-
-        # Note: A lot of this code is superfluous as we run config.h through cpp, but it does not cost much to be robust.
-        for token in matrix_rows.scanString(data):
-            matrix_row_pins.append(list(token[0]))
-
-        for token in matrix_cols.scanString(data):
-            matrix_col_pins.append(list(token[0]))
-
-        for token in matrix_diodes.scanString(data):
-            matrix_diode_dir.append(token[0].diodes)
+        for match in re.finditer(r'define[ \t]+(MATRIX_ROW_PINS|MATRIX_COL_PINS|DIODE_DIRECTION)\b[ \t]*([^\n]*)', data):
+            name, value = match.groups()
+            if name == 'DIODE_DIRECTION':
+                diodes = re.match(r'[A-Za-z0-9_]+', value)
+                if diodes:
+                    matrix_diode_dir.append(diodes.group(0))
+                continue
+            pins = re.match(r'\{([A-Za-z0-9,\s]*)\}', value)
+            if pins and name == 'MATRIX_ROW_PINS':
+                matrix_row_pins.append(re.findall(r'[A-Za-z0-9]+', pins.group(1)))
+            elif pins:
+                matrix_col_pins.append(re.findall(r'[A-Za-z0-9]+', pins.group(1)))
 
         if len(matrix_row_pins) == 1 and len(matrix_col_pins) == 1:
             matrix_data.append(matrix_row_pins[0])
@@ -291,8 +511,6 @@ class _ParseTxt:
     def rules_mk_mcu(data):
         """ Finds mcu data from rules.mk"""
 
-        data = str(data.replace('\\n', ' ').replace('\\r', ' ').replace('\\t', ' '))
-
         equals = (pp.Suppress('='))
 
         mcu_tag = pp.Suppress(pp.Literal('MCU'))
@@ -303,11 +521,33 @@ class _ParseTxt:
 
         return mcu.scanString(data)
 
+    def rules_mk_mcu_lines(lines):
+        """ Finds mcu data from rules.mk lines (i.e. an open file), without pyparsing
+
+        Reads up to the first MCU assignment made outside an ifeq/ifneq/ifdef/ifndef block - assignments inside one
+        are alternatives and are all listed. Handles =, ?=, :=, ::= and += assignments, and # comments. Returns a list
+        of mcu names, as rules_mk_mcu does for plain = assignments (see python -m q2k.bench.rules_mk for parity checks)
+        """
+
+        mcu_list = []
+        depth = 0
+        for line in lines:
+            line = line.split('#', 1)[0]
+            if re.match(r'\s*(ifeq|ifneq|ifdef|ifndef)\b', line):
+                depth += 1
+            elif re.match(r'\s*endif\b', line):
+                depth = max(depth - 1, 0)
+            else:
+                match = re.match(r'\s*(?:override\s+|export\s+)?MCU\s*(?:=|\?=|:=|::=|\+=)\s*([A-Za-z0-9_]+)', line)
+                if match:
+                    mcu_list.append(match.group(1))
+                    if not depth:
+                        break
+        return mcu_list
+
     def keymaps(data):
         """ Finds keycode layers (keymaps) from QMK keymap.c"""
 
-        data = str(data.replace('\\n', ' ').replace('\\r', ' ').replace('\\t', ' '))
-
         lbrac, rbrac, equals, comma = map(pp.Suppress, "{}=,")
 
         keycode = pp.Word(pp.alphanums+'_'+'('+')')
@@ -327,8 +567,6 @@ class _ParseTxt:
     def keymap_functions(data):
         """ Finds legacy TMK/QMK style functions from QMK keymap.c"""
 
-        data = str(data.replace('\\n', ' ').replace('\\r', ' ').replace('\\t', ' '))
-
         lsqbrac, rsqbrac, equals, comma = map(pp.Suppress, "[]=,")
 
         words = pp.Word(pp.alphanums+'_')
@@ -348,26 +586,414 @@ class _ParseTxt:
 
         return results
 
+class _Timings:
+    """ A private class recording wall/CPU time of conversion stages and preprocessor runs, plus conversion counts
+
+    CPU time of preprocessor runs is the CPU time of the child process (not available on Windows, where it is always 0).
+    """
+
+    def __init__(self):
+        self.stages = {}             # Stage name -> {'wall': seconds, 'cpu': seconds}
+        self.preproc = []            # List of {'file': path, 'wall': seconds, 'cpu': seconds} - one per preprocessor run
+        self.counts = {}             # Count name -> integer, i.e. layers, keys, keymap_tokens
+
+    def stage(self, name, func):
+        """ Run func() as a named stage, recording its wall and CPU time"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return func()
+        finally:
+            self.stages[name] = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+
+    def subprocess(self, path, argv, **kwargs):
+        """ Run subprocess.check_output(argv), recording its wall time and child CPU time"""
+        wall, children = time.perf_counter(), os.times()
+        try:
+            return subprocess.check_output(argv, **kwargs)
+        finally:
+            after = os.times()
+            cpu = (after.children_user - children.children_user) + (after.children_system - children.children_system)
+            self.preproc.append({'file': path, 'wall': time.perf_counter() - wall, 'cpu': cpu})
+
+    def stream(self, path, argv, stop, **kwargs):
+        """ Run argv, reading its output as it is written - like subprocess(), but once stop(output read so far) returns
+        an end offset, the process is killed and the output up to that offset returned
+        """
+        wall, children = time.perf_counter(), os.times()
+        output = bytearray()
+        try:
+            with subprocess.Popen(argv, stdout=subprocess.PIPE, **kwargs) as proc:
+                while True:
+                    chunk = proc.stdout.read1(65536)
+                    if not chunk:
+                        break
+                    output += chunk
+                    end = stop(output)
+                    if end:
+                        proc.kill()
+                        self.count('preproc_stopped_early')
+                        return bytes(output[:end])
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, argv, bytes(output))
+            return bytes(output)
+        finally:
+            after = os.times()
+            cpu = (after.children_user - children.children_user) + (after.children_system - children.children_system)
+            self.preproc.append({'file': path, 'wall': time.perf_counter() - wall, 'cpu': cpu})
+
+    def count(self, name, value=1):
+        """ Add value to a named count"""
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def report(self):
+        """ Timing report as a JSON serialisable dictionary"""
+        return {
+            'stages'       : self.stages,
+            'preprocessor' : self.preproc,
+            'counts'       : self.counts,
+            'total'        : {
+                'wall' : sum(stage['wall'] for stage in self.stages.values()),
+                'cpu'  : sum(stage['cpu'] for stage in self.stages.values()),
+            },
+        }
+
+    def percentile(values, pct):
+        """ Linearly interpolated percentile (0-100) of a list of numbers"""
+        values = sorted(values)
+        if not values:
+            return 0.0
+        k = (len(values) - 1) * pct / 100.0
+        low = int(k)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (k - low)
+
+    def aggregate(reports):
+        """ Aggregate several timing reports into per-stage percentiles (batch conversions)"""
+
+        samples = {}
+        for report in reports:
+            for name, stage in report['stages'].items():
+                samples.setdefault(name, []).append(stage)
+            for run in report['preprocessor']:
+                samples.setdefault('preprocessor', []).append(run)
+            samples.setdefault('total', []).append(report['total'])
+
+        aggregate = {}
+        for name, stages in samples.items():
+            aggregate[name] = {'count': len(stages)}
+            for kind in ('wall', 'cpu'):
+                values = [stage[kind] for stage in stages]
+                aggregate[name][kind] = {
+                    'mean' : sum(values) / len(values),
+                    'p50'  : _Timings.percentile(values, 50),
+                    'p90'  : _Timings.percentile(values, 90),
+                    'p99'  : _Timings.percentile(values, 99),
+                    'max'  : max(values),
+                }
+        return aggregate
+
+class _Profiler:
+    """ A private class capturing a cProfile profile and/or a tracemalloc allocation report of a function call
+
+    Attributes:
+        profile_dir(str) : Directory for <name>.prof files (blank to disable)
+        memory_dir(str)  : Directory for <name>.mem.txt allocation reports (blank to disable)
+        top(int)         : Number of allocation sites listed in each allocation report
+    """
+
+    def __init__(self, profile_dir='', memory_dir='', top=25):
+        self.profile_dir = profile_dir
+        self.memory_dir = memory_dir
+        self.top = top
+
+    def enabled(self):
+        return bool(self.profile_dir or self.memory_dir)
+
+    def sampled(index, fraction):
+        """ Whether the job at this index is one of an evenly spread fraction (0-1) of jobs"""
+        return int((index + 1) * fraction) > int(index * fraction)
+
+    def run(self, name, func, files=None):
+        """ Run func(), writing <name>.prof and/or <name>.mem.txt. Returns (result, list of written files)
+
+        Args:
+            files(list): List to append written files to - filled in even if func() raises
+        """
+
+        profile = cProfile.Profile() if self.profile_dir else None
+        tracing = self.memory_dir and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if profile:
+            profile.enable()
+        if files is None:
+            files = []
+        try:
+            return func(), files
+        finally:
+            if profile:
+                profile.disable()
+            if tracing:
+                # Snapshot before writing the profile, so its allocations are not reported
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            if profile:
+                path = os.path.join(self.profile_dir, name+'.prof')
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profile.dump_stats(path)
+                files.append(path)
+            if tracing:
+                path = os.path.join(self.memory_dir, name+'.mem.txt')
+                os.makedirs(self.memory_dir, exist_ok=True)
+                self.__write_memory(path, name, snapshot, current, peak)
+                files.append(path)
+
+    def __write_memory(self, path, name, snapshot, current, peak):
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.statistics('lineno')
+        lines = ['# '+name, '# Current: {:.1f} KiB, peak: {:.1f} KiB'.format(current / 1024, peak / 1024),
+                 '# Top {} allocation sites of {}'.format(min(self.top, len(stats)), len(stats)), '']
+        for stat in stats[:self.top]:
+            frame = stat.traceback[0]
+            lines.append('{:>10.1f} KiB {:>8} blocks  {}:{}'.format(stat.size / 1024, stat.count, frame.filename, frame.lineno))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines)+'\n')
+
+class Preprocessor(abc.ABC):
+    """ Abstract base class for C preprocessor backends used to read QMK source files
+
+    A backend is handed the preprocessor arguments (everything after the compiler executable, i.e. -E, -D, -I options
+    and the input file last) and returns the preprocessed output as bytes, which _Cpp decodes once as ENCODING before
+    it is parsed. Backends implement run(); stream() and bind() have working defaults. Set Q2KApp.preprocessor to swap
+    backends.
+    """
+
+    ENCODING = 'utf-8'                          # Encoding of QMK sources - undecodable bytes are replaced
+
+    @abc.abstractmethod
+    def run(self, args, timings):
+        """ Preprocess - raises subprocess.CalledProcessError/OSError if the preprocessor fails, KeyError if no output is available"""
+
+    def stream(self, args, timings, stop):
+        """ Preprocess, returning the output up to the end offset stop(output) returns once enough of it has been seen
+
+        Backends which read the output as it is written override this to stop the preprocessor early
+        """
+        output = self.run(args, timings)
+        end = stop(output)
+        return output[:end] if end else output
+
+    def bind(self, dirs):
+        """ Called with the Q2KApp directories before preprocessing"""
+        pass
+
+    def wants(self, args):
+        """ True if the backend needs to see args even when their output is not used, i.e. to record it"""
+        return False
+
+    def named(name, fallback='avr-gcc'):
+        """ Preprocessor backend by name: avr-gcc, cpp (host preprocessor) or replay (recording in-process stand-in)
+
+        Args:
+            fallback(str): With replay, the backend (avr-gcc or cpp) preprocessing inputs not recorded yet
+        """
+        if name == 'cpp':
+            return CompilerPreprocessor(Defaults.HOST_CPP)
+        if name == 'replay':
+            return ReplayPreprocessor(fallback=Preprocessor.named('cpp' if fallback == 'cpp' else 'avr-gcc'))
+        return CompilerPreprocessor()
+
+class CompilerPreprocessor(Preprocessor):
+    """ Preprocessor backend running a compiler executable - avr-gcc by default, or i.e. the host cpp"""
+
+    def __init__(self, command=''):
+        self.command = command       # Executable to run. Blank means Defaults.AVR_GCC (looked up when run)
+
+    def run(self, args, timings):
+        argv = [self.command or Defaults.AVR_GCC] + args
+        if platform.system() == 'Windows':
+            startup = subprocess.STARTUPINFO()
+            startup.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            return timings.subprocess(args[-1], argv, stdin=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startup)
+        return timings.subprocess(args[-1], argv)
+
+    def stream(self, args, timings, stop):
+        argv = [self.command or Defaults.AVR_GCC] + args
+        if platform.system() == 'Windows':
+            startup = subprocess.STARTUPINFO()
+            startup.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            return timings.stream(args[-1], argv, stop, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, startupinfo=startup)
+        return timings.stream(args[-1], argv, stop)
+
+class ReplayPreprocessor(Preprocessor):
+    """ Deterministic, in-process preprocessor backend which replays recorded outputs instead of spawning a compiler
+
+    Inputs without a recorded output are preprocessed by the fallback backend (and recorded), or raise KeyError if
+    there is no fallback. Used to measure parsing and conversion without compiler spawn cost.
+
+    Records can be saved to and loaded from a gzip compressed JSON archive. Paths in input keys are stored relative
+    to the QMK and local lib directories, so an archive can be replayed against a checkout in another location.
+    """
+
+    ARCHIVE_FORMAT = 'q2k-preproc'
+    ARCHIVE_VERSION = 1
+
+    def __init__(self, records=None, fallback=None):
+        self.records = records if records is not None else {}  # Input key -> recorded output
+        self.fallback = fallback                               # Preprocessor for inputs not yet recorded
+        self.roots = []                                        # (directory, placeholder) pairs for input keys
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, dirs):
+        self.roots = [(os.path.abspath(dirs['QMK dir']), '$QMK'), (os.path.abspath(dirs['Local libs']), '$LIBS')]
+        if self.fallback:
+            self.fallback.bind(dirs)
+
+    def key(self, args):
+        """ Input key of a preprocessor argument list"""
+
+        key = []
+        for arg in args:
+            for root, placeholder in self.roots:
+                index = arg.find(root)
+                if index != -1:
+                    arg = arg[:index] + placeholder + arg[index+len(root):].replace(os.sep, '/')
+                    break
+            key.append(arg)
+        return '\n'.join(key)
+
+    def wants(self, args):
+        return self.fallback is not None and self.key(args) not in self.records
+
+    def run(self, args, timings):
+        key = self.key(args)
+        if key in self.records:
+            self.hits += 1
+            timings.count('preproc_replayed')
+            return self.records[key]
+        if not self.fallback:
+            raise KeyError(args[-1])
+        output = self.fallback.run(args, timings)
+        self.misses += 1
+        self.records[key] = output
+        return output
+
+    def save(self, path):
+        """ Write all records to a compressed archive at path"""
+
+        archive = {
+            'format'  : ReplayPreprocessor.ARCHIVE_FORMAT,
+            'version' : ReplayPreprocessor.ARCHIVE_VERSION,
+            'q2k'     : Defaults.VERSION,
+            'records' : {key: output.decode('latin-1') for key, output in self.records.items()},
+        }
+        with gzip.open(path, 'wt', encoding='utf8') as f:
+            json.dump(archive, f, sort_keys=True)
+
+    def load(path, fallback=None):
+        """ ReplayPreprocessor holding the records of a compressed archive - raises OSError or ValueError if path is not a valid archive"""
+
+        with gzip.open(path, 'rt', encoding='utf8') as f:
+            archive = json.load(f)
+        if not isinstance(archive, dict) or archive.get('format') != ReplayPreprocessor.ARCHIVE_FORMAT:
+            raise ValueError('Not a preprocessor archive: '+path)
+        if archive.get('version') != ReplayPreprocessor.ARCHIVE_VERSION:
+            raise ValueError('Unsupported preprocessor archive version '+str(archive.get('version'))+': '+path)
+        records = {key: output.encode('latin-1') for key, output in archive['records'].items()}
+        return ReplayPreprocessor(records, fallback)
+
+class _ArrayScan:
+    """ A private class watching preprocessor output for the end of array initializers, i.e. keymaps[] and fn_actions[]
+
+    Called with the output read so far, it returns the offset just past the last of the initializers once all of them
+    have been closed (0 until then). Only output not yet scanned is looked at on each call.
+    """
+
+    BRACES = re.compile(rb'[{}]')
+
+    def __init__(self, names):
+        self.__pattern = re.compile(rb'\b(' + b'|'.join(names) + rb')\s*\[[^=;{}]*=\s*\{')
+        self.__wanted = set(names)
+        self.__current = b''
+        self.__depth = 0                          # Brace depth inside the current initializer
+        self.__pos = 0                            # Output scanned so far
+        self.__end = 0
+
+    def __call__(self, output):
+        while self.__wanted:
+            if not self.__depth:
+                match = self.__pattern.search(output, self.__pos)
+                if not match:
+                    self.__pos = max(self.__pos, len(output) - 256)    # A declaration may be split between reads
+                    return 0
+                self.__current = bytes(match.group(1))
+                self.__depth = 1
+                self.__pos = match.end()
+            for brace in _ArrayScan.BRACES.finditer(output, self.__pos):
+                self.__depth += 1 if brace.group() == b'{' else -1
+                if not self.__depth:
+                    self.__wanted.discard(self.__current)
+                    self.__pos = self.__end = brace.end()
+                    break
+            else:
+                self.__pos = len(output)
+                return 0
+        return self.__end
+
 class _Cpp:
-    """" A private class containing functions for opening QMK source files and passing input onto the avr-gcc preprocesso"""
+    """" A private class containing functions for opening QMK source files and passing input onto the avr-gcc preprocessor (or another Preprocessor backend)"""
 
-    def __init__(self, kbo, dirs, console):
+    def __init__(self, kbo, dirs, console, timings=None, preprocessor=None, early_stop=True, lib_profile='full'):
         self.__kb = kbo
         self.__dirs = dirs
         self.__console = console
+        self.__timings = timings or _Timings()
+        self.__preprocessor = preprocessor or CompilerPreprocessor()
+        self.__preprocessor.bind(dirs)
+        self.dependencies = set()    # Every file read by the preprocessor (from its linemarkers), except system headers
+        self.keymap_sources = set()  # keymap.c and the headers it includes, as found by keymap_key()
+        self.early_stop = early_stop # Stop preprocessing keymap.c once keymaps[] (and fn_actions[]) have been read
+        self.lib_profile = lib_profile # Include stub profile (see Defaults.LIB_PROFILES)
+
+    def __local_libs(self):
+        """ Local lib folders to search, in order - the stub folder of the include stub profile comes first"""
+
+        stubs = Defaults.LIB_PROFILES.get(self.lib_profile, '')
+        if stubs:
+            return [os.path.join(self.__dirs['Local libs'], stubs), self.__dirs['Local libs']]
+        return [self.__dirs['Local libs']]
+
+    def __linemarker_files(self, output):
+        """ Files entered by the preprocessor according to the linemarkers of its output (system headers left out)"""
+
+        files = set()
+        for match in re.finditer(rb'^# \d+ "((?:[^"\\]|\\.)*)"([ 0-9]*)\r?$', output, re.M):
+            name = match.group(1).decode('utf8', 'replace').replace('\\\\', '\\')
+            if name.startswith('<') or b'3' in match.group(2).split():
+                continue
+            files.add(os.path.normpath(name))
+        return files
+
+    def __preproc(self, kblibs, arg_list, debug=False, stop=None, unseen=False):
+        """ Runs AVR-GCC Preprocessor, including all relevant header files and strips layout macros, comments and user-defined macros and defines
 
-    def __preproc(self, kblibs, arg_list, debug=False):
-        """ Runs AVR-GCC Preprocessor, including all relevant header files and strips layout macros, comments and user-defined macros and defines"""
+        With unseen, the preprocessor only runs if the backend wants these arguments (see Preprocessor.wants)
+        """
 
         # Setting up -I and custom define options
         qdir = os.path.join(self.__dirs['QMK dir'], 'keyboards')
         kb_n = self.__kb.name
-        cpp = [Defaults.AVR_GCC, '-E']
+        cpp = ['-E']
         kbdefine = ['KEYBOARD'] + kblibs
         kbdefine = '_'.join(kbdefine)
         qmk_keyboard_h = 'QMK_KEYBOARD_H=\"'+ kb_n +'.h\"'
-        locallib = '-I'+self.__dirs['Local libs']
-        libs = ['-D', kbdefine, '-D', qmk_keyboard_h, locallib]
+        libs = ['-D', kbdefine, '-D', qmk_keyboard_h]
+        # -I folders are searched before the system folders, so stubs of system headers (stdio.h, avr/pgmspace.h, ...)
+        # are used where the profile has them, and the compiler's headers otherwise
+        for locallib in self.__local_libs():
+            libs.append('-I'+locallib)
         path = qdir
         for kbl in kblibs:
             path = os.path.join(path, kbl)
@@ -375,21 +1001,22 @@ class _Cpp:
             libs.append(this_lib)
 
         argv = cpp + libs + arg_list
+        if unseen and not self.__preprocessor.wants(argv):
+            return None
         if debug: 
             print(' '.join(argv))
 
         try:
-            if platform.system() == 'Linux':
-
-                output = subprocess.check_output(argv)
-
-            elif platform.system() == 'Windows':
-                startup = subprocess.STARTUPINFO()
-                startup.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-                output = subprocess.check_output(argv, stdin=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startup)
+            if stop:
+                output = self.__preprocessor.stream(argv, self.__timings, stop)
+            else:
+                output = self.__preprocessor.run(argv, self.__timings)
+            self.dependencies |= self.__linemarker_files(output)
             return output
 
+        except KeyError:
+            self.__console.warning(['No recorded preprocessor output for '+argv[-1]])
+
         except subprocess.CalledProcessError as error:
             err_num = error.returncode
             if err_num == errno.EPERM:
@@ -412,11 +1039,16 @@ class _Cpp:
 
         arg = ['-D', 'QMK_KEYBOARD_CONFIG_H=\"config_common.h\"', '-dD', path]
         if os.path.isfile(path):
-            output = str(self.__preproc(kblibs, arg))
-            return output
+            return self.__decode(self.__preproc(kblibs, arg))
 
-    def preproc_keymap(self):
-        """ Initialize preprocessing QMK keymap.c files"""
+    def __decode(self, output):
+        """ Preprocessor output bytes as text ('' if preprocessing failed)"""
+        if not output:
+            return ''
+        return output.decode(Preprocessor.ENCODING, errors='replace')
+
+    def __keymap_path(self):
+        """ Path of the keymap.c file of the current build, and the keyboard lib folders to preprocess it with"""
 
         qdir = os.path.join(self.__dirs['QMK dir'], 'keyboards')
         kb_n = self.__kb.name
@@ -426,19 +1058,111 @@ class _Cpp:
         if rev_n != '':
             kblibs.append(rev_n)
 
-        # KEYMAP
         keym = os.path.join(qdir, kb_n, rev_n, 'keymaps', km_n)
         if not os.path.isfile(keym):
             keym = os.path.join(qdir, kb_n, 'keymaps', km_n)
+        return keym, kblibs
+
+    def __normalize_source(self, text):
+        """ C source with comments, blank lines and redundant whitespace removed (string literals are kept as they are)"""
+
+        def strip_comment(match):
+            if match.group(1):
+                return match.group(1)
+            return '\n' if '\n' in match.group(0) else ' '
+
+        text = re.sub(r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|/\*.*?\*/|//[^\n]*', strip_comment, text, flags=re.S)
+        lines = [' '.join(line.split()) for line in text.splitlines()]
+        return '\n'.join(line for line in lines if line)
+
+    def keymap_key(self):
+        """ Hash of the normalized keymap.c source of the current build together with every header it includes
+
+        Keymaps with the same key preprocess to the same keycodes. Headers are resolved like the preprocessor does (the
+        including file's folder, then the -I folders) and hashed by content, so identical keymaps of boards with
+        different headers get different keys. Returns '' if the keymap cannot be read.
+        """
+
+        keym, kblibs = self.__keymap_path()
+        if not os.path.isfile(keym):
+            return ''
+        qdir = os.path.join(self.__dirs['QMK dir'], 'keyboards')
+        search = self.__local_libs()
+        path = qdir
+        for kbl in kblibs:
+            path = os.path.join(path, kbl)
+            search.append(path)
+        kbdefine = '_'.join(['KEYBOARD'] + kblibs)
+        include = re.compile(r'^\s*#\s*include\s*(?:"([^"]+)"|<([^>]+)>|(QMK_KEYBOARD_H))', re.M)
+
+        digest = hashlib.sha1()
+        pending = [keym]
+        seen = set()
+        while pending:
+            source = pending.pop(0)
+            if source in seen:
+                continue
+            seen.add(source)
+            try:
+                with open(source, 'r', encoding='utf8', errors='replace') as f:
+                    text = self.__normalize_source(f.read())
+            except OSError:
+                return ''
+            digest.update(text.encode('utf8'))
+            digest.update(b'\0')
+            if re.search(r'\bKEYBOARD_', text):
+                digest.update(kbdefine.encode('utf8'))
+            for quoted, angled, keyboard_h in include.findall(text):
+                name = keyboard_h and self.__kb.name+'.h' or quoted or angled
+                dirs = search if angled else [os.path.dirname(source)] + search
+                for folder in dirs:
+                    header = os.path.join(folder, name)
+                    if os.path.isfile(header):
+                        pending.append(header)
+                        break
+                else:
+                    digest.update(('#include '+name+'\0').encode('utf8'))
+        self.keymap_sources = seen
+        return digest.hexdigest()
+
+    def preproc_keymap(self):
+        """ Initialize preprocessing QMK keymap.c files"""
+
+        keym, kblibs = self.__keymap_path()
 
         # OUTPUT
         argkm = [keym]
         if os.path.isfile(keym):
-            output = str(self.__preproc(kblibs, argkm))
-            return output
+            stop = None
+            if self.early_stop:
+                # Legacy fn_actions[] may be defined in keymap.c or in a header it includes, even after keymaps[] - wait
+                # for them if any of these files mention them. If the headers cannot be found, keymap.c is read in full
+                if keym not in self.keymap_sources:
+                    self.keymap_key()
+                if keym in self.keymap_sources:
+                    names = [b'keymaps', b'fn_actions'] if any(self.__mentions(source, b'fn_actions') for source in self.keymap_sources) else [b'keymaps']
+                    stop = _ArrayScan(names)
+            return self.__decode(self.__preproc(kblibs, argkm, stop=stop))
         else:
             self.__console.error(['Keymap cannot be read by preprocessor', 'Failed to parse keymap file'])
 
+    def __mentions(self, source, name):
+        """ True if the file source contains name (or cannot be read)"""
+        try:
+            with open(source, 'rb') as f:
+                return name in f.read()
+        except OSError:
+            return True
+
+    def record_keymap(self):
+        """ Pass the keymap.c of the current build to the preprocessor backend if it wants it although its output is not
+        needed (an identical keymap was converted before), so recording backends still get every keymap
+        """
+
+        keym, kblibs = self.__keymap_path()
+        if os.path.isfile(keym):
+            self.__preproc(kblibs, [keym], unseen=True)
+
 class KBInfo:
     """" A container class for keyboard information"""
 
@@ -493,6 +1217,7 @@ class RevInfo:
         self.template_list = []      # List of template NAMES
         self.template_loc = ''       # Location of <keyboard>.h
         self.is_rev = is_rev         # Does keyboard have revisions? (or just default)
+        self.scanned = True          # MCU validated and templates found? (False until first used with a fast scan cache)
 
     def init_build(self):
         """ Initialize build variables"""
@@ -555,6 +1280,7 @@ class KeycodeLayer:
         """ Convert this keycode layer's layout from QMK KC format to keyplus KC format"""
 
         for i, keyc in enumerate(self.keymap):
+            console.kc_location = (self.name, i)
             if keyc.endswith(')') and '(' in keyc:
                 self.keymap[i] = self.__func(keyc, layer_names, functions, console)
             else:
@@ -612,8 +1338,7 @@ class KeycodeLayer:
                 # Split up into [TAP_LAYER], [HOLD_KC]
                 split = func_target.split(',', 1)
                 if len(split) != 2:
-                    kc_err_out = ''.join(['[', qmk_func, '] - set to ', invalid])
-                    console.bad_kc('FN', kc_err_out)
+                    console.bad_kc('FN', qmk_func)
                     return invalid
                 else:
                     first = split[0].replace(' ', '')
@@ -694,8 +1419,7 @@ class KeycodeLayer:
             elif qfunc == 'MT(':
                 split = func_target.split(',', 1)
                 if len(split) != 2:
-                    kc_err_out = ''.join(['[', qmk_func, '] - set to ', invalid])
-                    console.bad_kc('FN', kc_err_out)
+                    console.bad_kc('FN', qmk_func)
                     return invalid
                 else:
                     modifier = split[0]
@@ -751,43 +1475,444 @@ class KeycodeLayer:
                 return keyp_kc
 
         # If we didn't get a match, return [invalid]
-        kc_err_out = ''.join(['[', qmk_kc, '] - set to ', invalid])
-        console.bad_kc('KC', kc_err_out)
+        console.bad_kc('KC', qmk_kc)
         return invalid
 
 # ===========================================================================================
 # Cached Lists and Dictionaries
 # ===========================================================================================
+class SearchResult:
+    """" A container class for keyboard search results"""
+
+    def __init__(self, keyboard='', rev='', field='', value='', score=0.0):
+
+        self.keyboard = keyboard     # Name of keyboard this result belongs to
+        self.rev = rev               # Name of revision (blank if result applies to the whole keyboard)
+        self.field = field           # Which field matched: keyboard, revision, keymap or template
+        self.value = value           # The matching name
+        self.score = score           # Rank of this result (higher is better)
+
+class _SearchIndex:
+    """ A private class holding an n-gram inverted index of keyboard, revision, keymap and template names
+
+    Attributes:
+        FIELD_WEIGHT(dict) : Rank multiplier for each searchable field
+        MIN_SCORE(float)   : Minimum n-gram similarity for a fuzzy (non-substring) match
+    """
+
+    FIELD_WEIGHT = {'keyboard': 1.0, 'revision': 0.9, 'template': 0.8, 'keymap': 0.7}
+    MIN_SCORE = 0.4
+
+    def __init__(self, kbo_list, n=2):
+
+        self.__n = n
+        self.__values = []           # List of (field, name) tuples - one per distinct name in each field
+        self.__lower = []            # Lowercase copy of each name
+        self.__grams = []            # Set of n-grams for each name
+        self.__owners = []           # List of (keyboard, rev) tuples for each name
+        self.__ids = {}              # (field, name) -> value id
+        self.__index = {}            # n-gram -> set of value ids
+
+        for kbo in kbo_list:
+            self.__add('keyboard', kbo.name, kbo.name, '')
+            for revo in kbo.rev_info:
+                rev_n = revo.name if revo.is_rev else ''
+                if revo.is_rev:
+                    self.__add('revision', revo.name, kbo.name, rev_n)
+                for keym in revo.keymap_list:
+                    self.__add('keymap', keym, kbo.name, rev_n)
+                for temp in revo.template_list:
+                    self.__add('template', temp, kbo.name, rev_n)
+
+    def __ngrams(self, string):
+        """ Split a (lowercase) string into a set of boundary padded n-grams"""
+
+        padded = ''.join(['^', string, '$'])
+        if len(padded) <= self.__n:
+            return {padded}
+        return {padded[i:i+self.__n] for i in range(len(padded)-self.__n+1)}
+
+    def __add(self, field, name, keyboard, rev):
+        """ Add a name to the index, or a new owner to an already indexed name"""
+
+        key = (field, name)
+        vid = self.__ids.get(key)
+        if vid is None:
+            vid = len(self.__values)
+            self.__ids[key] = vid
+            self.__values.append(key)
+            lower = name.lower()
+            self.__lower.append(lower)
+            grams = self.__ngrams(lower)
+            self.__grams.append(grams)
+            self.__owners.append([])
+            for gram in grams:
+                self.__index.setdefault(gram, set()).add(vid)
+        owner = (keyboard, rev)
+        if owner not in self.__owners[vid]:
+            self.__owners[vid].append(owner)
+
+    def search(self, string, fields=None, limit=None):
+        """ Return a ranked list of SearchResult objects matching this string (case-insensitive, typo-tolerant)"""
+
+        query = string.strip().lower()
+        if not query:
+            return []
+
+        q_grams = self.__ngrams(query)
+        common = {}
+        for gram in q_grams:
+            for vid in self.__index.get(gram, ()):
+                common[vid] = common.get(vid, 0) + 1
+
+        # Queries shorter than a single n-gram will not share grams with most names - fall back to a substring scan
+        if len(query) < self.__n:
+            for vid, lower in enumerate(self.__lower):
+                if query in lower:
+                    common.setdefault(vid, 0)
+
+        ranked = []
+        for vid, count in common.items():
+            field, name = self.__values[vid]
+            if fields and field not in fields:
+                continue
+            lower = self.__lower[vid]
+            similarity = 2.0 * count / (len(q_grams) + len(self.__grams[vid]))
+            if lower == query:
+                bonus = 1.0
+            elif lower.startswith(query) or ('/'+query) in lower or ('_'+query) in lower:
+                bonus = 0.5
+            elif query in lower:
+                bonus = 0.3
+            elif similarity >= self.MIN_SCORE:
+                bonus = 0.0
+            else:
+                continue
+            ranked.append(((similarity + bonus) * self.FIELD_WEIGHT[field], vid))
+
+        ranked.sort(key=lambda item: (-item[0], self.__lower[item[1]]))
+
+        results = []
+        for score, vid in ranked:
+            field, name = self.__values[vid]
+            for keyboard, rev in self.__owners[vid]:
+                results.append(SearchResult(keyboard, rev, field, name, score))
+                if limit and len(results) >= limit:
+                    return results
+        return results
+
+class _FileLock:
+    """ A private class for an advisory lock on <path>.lock, shared between Q2K processes. Use as a context manager
+
+    Re-entrant within a thread. Raises TimeoutError (an OSError) if the lock is not acquired in time. Without fcntl or
+    msvcrt, only threads of this process are kept apart. The lock file is removed when the lock is released - a lock
+    taken on a lock file which was removed meanwhile is dropped and taken again on the new file.
+    """
+
+    TIMEOUT = 600.0
+    __held = {}                                     # (lock path, thread id) -> [open lock file, depth]
+    __guard = threading.Lock()
+
+    def __init__(self, path, timeout=None):
+        self.path = os.path.abspath(path) + '.lock'
+        self.timeout = _FileLock.TIMEOUT if timeout is None else timeout
+
+    def __try_lock(self, f):
+        """ Try to lock the open lock file f - returns True if locked, False if held elsewhere, None if f was removed"""
+        try:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if not self.__current(f):
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    return None
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                if not self.__current(f):
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                    return None
+            else:
+                for key in _FileLock.__held:
+                    if key[0] == self.path:
+                        return False
+            return True
+        except OSError:
+            return False
+
+    def __current(self, f):
+        """ True if the open lock file f is still the file at the lock path (not removed by a release in between)"""
+        try:
+            path, opened = os.stat(self.path), os.fstat(f.fileno())
+        except FileNotFoundError:
+            return False
+        return (path.st_dev, path.st_ino) == (opened.st_dev, opened.st_ino)
+
+    def __enter__(self):
+        key = (self.path, threading.get_ident())
+        with _FileLock.__guard:
+            if key in _FileLock.__held:
+                _FileLock.__held[key][1] += 1
+                return self
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        f = open(self.path, 'a+')
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with _FileLock.__guard:
+                locked = self.__try_lock(f)
+                if locked:
+                    _FileLock.__held[key] = [f, 1]
+                    return self
+            if locked is None:
+                f.close()
+                f = open(self.path, 'a+')
+                continue
+            if time.monotonic() > deadline:
+                f.close()
+                raise TimeoutError('Timed out waiting for lock '+self.path)
+            time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        key = (self.path, threading.get_ident())
+        with _FileLock.__guard:
+            held = _FileLock.__held[key]
+            held[1] -= 1
+            if held[1]:
+                return
+            del _FileLock.__held[key]
+            f = held[0]
+            try:
+                if fcntl:
+                    # Removed while still locked, so a waiting process notices it locked a stale file
+                    self.__remove()
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                elif msvcrt:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                f.close()
+            if not fcntl:
+                # Fails while another process has the file open (Windows) - it is removed by the last one
+                self.__remove()
+
+    def __remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def _write_atomic(path, write):
+    """ Write a text file through write(file) to a temporary file, then rename it over path - readers never see a partial file"""
+
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    fd, temp = tempfile.mkstemp(prefix='.'+os.path.basename(path)+'.', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        mask = os.umask(0)
+        os.umask(mask)
+        os.chmod(temp, 0o666 & ~mask)   # mkstemp creates files readable by the owner only
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+class _CacheNamespace:
+    """ A private class locating the cache files of one QMK checkout
+
+    Each QMK directory has its own folder next to the cache yaml (qmk-<hash of the resolved path>), holding one cache
+    per checked out commit (cache_kb-<commit>.yaml) and its deps_kb.json. namespaces.json records when each cache was
+    last used - beyond Defaults.CACHE_LIMIT caches, the least recently used are removed.
+
+    Attributes:
+        root(str)   : Cache folder
+        qmk(str)    : Resolved QMK directory
+        commit(str) : Commit checked out in the QMK directory (blank if it is not a git checkout)
+        folder(str) : Cache folder of this QMK directory
+        cache(str)  : Path to the cached KBInfo list of this QMK directory and commit
+    """
+
+    INDEX = 'namespaces.json'
+
+    def __init__(self, dirs):
+        self.root = os.path.dirname(os.path.abspath(dirs['Cache']))
+        self.qmk = os.path.realpath(dirs['QMK dir'])
+        self.commit = _CacheNamespace.git_commit(self.qmk)
+        self.folder = os.path.join(self.root, 'qmk-'+hashlib.sha1(self.qmk.encode('utf8')).hexdigest()[:10])
+        name, ext = os.path.splitext(os.path.basename(dirs['Cache']))
+        if self.commit:
+            name += '-' + self.commit[:12]
+        self.cache = os.path.join(self.folder, name+ext)
+
+    def git_commit(qmk):
+        """ Commit checked out in the git repository qmk, read from .git without running git - blank if unknown"""
+
+        git = os.path.join(qmk, '.git')
+        try:
+            if os.path.isfile(git):                                 # Worktrees and submodules - 'gitdir: <path>'
+                with open(git, 'r') as f:
+                    git = os.path.join(qmk, f.read().strip()[len('gitdir:'):].strip())
+            common = git
+            if os.path.isfile(os.path.join(git, 'commondir')):      # Worktrees share refs with the main repository
+                with open(os.path.join(git, 'commondir'), 'r') as f:
+                    common = os.path.join(git, f.read().strip())
+            with open(os.path.join(git, 'HEAD'), 'r') as f:
+                head = f.read().strip()
+            if not head.startswith('ref:'):
+                return head                                         # Detached HEAD
+            ref = head[len('ref:'):].strip()
+            for folder in (git, common):
+                path = os.path.join(folder, *ref.split('/'))
+                if os.path.isfile(path):
+                    with open(path, 'r') as f:
+                        return f.read().strip()
+            with open(os.path.join(common, 'packed-refs'), 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == ref:
+                        return fields[0]
+        except OSError:
+            pass
+        return ''
+
+    def touch(self):
+        """ Mark this cache as the most recently used, and remove the least recently used beyond Defaults.CACHE_LIMIT"""
+
+        index_loc = os.path.join(self.root, _CacheNamespace.INDEX)
+        with _FileLock(index_loc):
+            try:
+                with open(index_loc, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            name = os.path.relpath(self.cache, self.root).replace(os.sep, '/')
+            index[name] = {'qmk': self.qmk, 'commit': self.commit, 'used': time.time()}
+
+            by_age = sorted(index, key=lambda n: index[n].get('used', 0))
+            for old in by_age[:max(len(index) - max(Defaults.CACHE_LIMIT, 1), 0)]:
+                path = os.path.join(self.root, *old.split('/'))
+                with _FileLock(path):
+                    if os.path.isfile(path):
+                        os.remove(path)
+                del index[old]
+            _write_atomic(index_loc, lambda f: json.dump(index, f, indent=1, sort_keys=True))
+
 class _Cache:
-    """" A private class for handling reading and writing from/to the application's cached list of KBInfo objects"""
+    """" A private class for handling reading and writing from/to the application's cached list of KBInfo objects
+
+    cache_kb.yaml is replaced atomically under a _FileLock. If there is no cache yet, the lock is held while it is
+    generated, so parallel Q2K processes wait for one cache instead of each generating their own. Each QMK checkout
+    and commit has its own cache (see _CacheNamespace), so switching between checkouts does not regenerate it.
 
-    def __init__(self, dirs, console, f_cache=False):
+    The cache carries its schema version. Caches of an older schema are upgraded by MIGRATIONS (schema -> function
+    returning the cache in the next schema) and saved again - a new cache is only generated if no migration exists.
+    Attributes added to KBInfo or RevInfo do not need a new schema, as missing attributes get their default values.
+
+    A fast scan cache only holds keyboard, revision and keymap names. The MCU of a keyboard's revisions is validated
+    and their layout templates are found when the keyboard is first used (_scan), or by a background pass (_scan_all),
+    and written back to the cache with _flush. Scans replace kbo_list and the revision lists of a keyboard instead of
+    changing them, so readers on other threads iterate a consistent snapshot. Messages of the background pass are
+    kept in scan_log, not printed.
+    """
+
+    SCHEMA = 1                                  # cache_kb.yaml format version
+
+    def migrate_0(cache):
+        """ Schema 0 (Q2K 1.2.5 and earlier) - a bare list of KBInfo objects"""
+        return {'schema': 1, 'keyboards': cache}
+
+    MIGRATIONS = {0: migrate_0}
+
+    def __init__(self, dirs, console, f_cache=False, cancel=None, progress=None, fast=False):
 
         self.kbo_list = []
 
-        self.__loc = dirs['Cache']
+        self.__namespace = _CacheNamespace(dirs)
+        self.__loc = self.__namespace.cache
+        self.__legacy = os.path.abspath(dirs['Cache'])  # Cache location before per checkout caches
         self.__qmk = dirs['QMK dir']
         self.__console = console
+        self.__messages = console                   # Where cache generation and scan messages go - scan_log during background scans
+        self.scan_log = _MessageLog()               # Messages of background scans (_scan_all)
+        self.__cancel = cancel                      # threading.Event - set to stop cache generation early
+        self.__on_progress = progress               # Callback taking CacheProgress events
+        self.__phase = ''
+        self.__phase_start = 0.0
+        self.__last_report = 0.0
+        self.__timings = {}
+        self.__fast = fast                          # Fast scan - leave MCU validation and template discovery until needed
+        self.__scan_lock = threading.RLock()        # Held while revisions are scanned on demand or the scans are saved
+        self.__dirty = False                        # Revisions scanned since the cache was saved
+        self.__stopped = threading.Event()          # Set when this cache is replaced - stops a background scan
+        self.__memo = {}                            # (kind, path) -> parsed rules.mk/<keyboard>.h, None if missing - per build or scan
+        self.__memo_stats = {'reads': 0, 'saved': 0}
 
         if not f_cache:
             self.__find()
         else:
             self.__write()
+        try:
+            self.__namespace.touch()
+        except OSError:
+            self.__console.warning(['Failed to update '+os.path.join(self.__namespace.root, _CacheNamespace.INDEX)])
+
+        self.__index = _SearchIndex(self.kbo_list)  # Prebuilt search index - rebuilt whenever kbo_list is (None until needed again)
 
     def __find(self):
         """ Find cached cache_kb.yaml"""
 
-        if os.path.isfile(self.__loc):
+        if not os.path.isfile(self.__loc) and os.path.isfile(self.__legacy):
             try:
-                with open(self.__loc, 'r') as f:
-                    self.kbo_list = yaml.load(f)
-                    self.__console.note(['Using cached list from '+self.__loc, '--cache to reset'])
-            except:
-                self.__console.warning(['Failed to load from '+self.__loc])
-                self.__write()
-        else:
+                os.makedirs(self.__namespace.folder, exist_ok=True)
+                os.replace(self.__legacy, self.__loc)
+            except OSError:
+                pass
+        if self.__load():
+            return
+        try:
+            with _FileLock(self.__loc):
+                # Another process may have generated the cache while we waited for the lock
+                if not self.__load(quiet=True):
+                    self.__write()
+        except TimeoutError:
+            self.__console.warning(['Timed out waiting for another Q2K process to generate '+self.__loc])
             self.__write()
 
+    def __load(self, quiet=False):
+        """ Load cache_kb.yaml if it exists - returns True if loaded"""
+
+        if not os.path.isfile(self.__loc):
+            return False
+        try:
+            with open(self.__loc, 'r') as f:
+                cache = yaml.load(f, Loader=yaml.Loader)
+            schema = cache.get('schema', 0) if isinstance(cache, dict) else 0
+            if any(old not in _Cache.MIGRATIONS for old in range(schema, _Cache.SCHEMA)) or schema > _Cache.SCHEMA:
+                if not quiet:
+                    self.__console.note(['Cache schema '+str(schema)+' of '+self.__loc+' is not supported'])
+                return False
+            for old in range(schema, _Cache.SCHEMA):
+                cache = _Cache.MIGRATIONS[old](cache)
+            self.kbo_list = _Cache.complete(cache['keyboards'])
+            if schema != _Cache.SCHEMA:
+                self.__save_cache()
+                self.__console.note(['Upgraded cached list from schema '+str(schema)+' to '+str(_Cache.SCHEMA), self.__loc])
+            else:
+                self.__console.note(['Using cached list from '+self.__loc, '--cache to reset'])
+            return True
+        except (OSError, ValueError, KeyError, yaml.YAMLError):
+            # Not a bare except - a fatal error saving the upgraded cache (SystemExit) must not be taken for a bad cache
+            if not quiet:
+                self.__console.warning(['Failed to load from '+self.__loc])
+            return False
+
 
     # Writing cache file
     # We need to find: Keyboard names, Revision names, LAYOUT template names, keymap.c file directories.
@@ -795,6 +1920,8 @@ class _Cache:
         """ Write cache_kb.yaml from KBInfo object list"""
 
         self.__console.note([Defaults.PRINT_LINES, 'Generating new cache_kb.yaml in '+self.__loc])
+        self.__memo = {}
+        self.__memo_stats = {'reads': 0, 'saved': 0}
 
         templist = []
         keymaplist = []
@@ -805,13 +1932,20 @@ class _Cache:
         # List of directories. Anything with a rules.mk file is considered a 'valid' dir for now.
         # This is the exact same logic used by QMK.
         # Format: qmk/keyboards/ ...    [ <anything> / ] rules.mk => templist
-        for filepath in glob.glob(os.path.join(qdir, '**', 'rules.mk'), recursive=True):
+        found = 0
+        self.__progress('discover')
+        for filepath in glob.iglob(os.path.join(qdir, '**', 'rules.mk'), recursive=True):
             filepath = os.path.split(filepath)[0]
             templist.append(filepath)
+            found += 1
+            self.__progress('discover', found)
 
         # List of keymap folders
         # Format: qmk/keyboards/ ...    [ <anything>  / keymaps / <any keymap> ] / keymap.c
-        for filepath in glob.glob(os.path.join(qdir, '**', 'keymaps', '**', 'keymap.c'), recursive=True):
+        for filepath in glob.iglob(os.path.join(qdir, '**', 'keymaps', '**', 'keymap.c'), recursive=True):
+            found += 1
+            self.__progress('discover', found)
+            self.__check_cancel()
             filepath = os.path.split(filepath)[0]
             # Important: If this exists in templist, then REMOVE it from templist.
             # i.e. removes  [ <? ... >/<keyboard>/<revisions>/keymaps/<any keymap>]
@@ -857,18 +1991,24 @@ class _Cache:
 
         # Adds default n/a revisions for keyboards with no revision
         total_kb_count = len(self.kbo_list)
-        remove_kbo = []
+        total_rev_count = 0
         for kbo in self.kbo_list:
             if not kbo.rev_list:
                 kbo.add_rev_list('n/a', is_rev=False)
+            total_rev_count += len(kbo.rev_info)
 
+        # Find + validate MCU
+        done = 0
+        self.__progress('validate', 0, total_rev_count)
+        remove_kbo = []
+        for kbo in self.kbo_list if not self.__fast else []:
+            self.__check_cancel()
             remove_revo = []
             for revo in kbo.rev_info:
-                # Find + validate MCU then layouts while we are doing this.
-                if self.__find_validate_mcu(kbo, revo):
-                    self.__find_layout_names(kbo, revo)
-                else:
+                if not self.__find_validate_mcu(kbo, revo):
                     remove_revo.append(revo)
+                done += 1
+                self.__progress('validate', done, total_rev_count)
             # deleting revisions
             for revo in remove_revo:
                 kbo.del_rev_info(revo.name)
@@ -881,9 +2021,25 @@ class _Cache:
 
         valid_kb_count = len(self.kbo_list)
 
+        # Find layouts for validated revisions
+        valid_rev_count = sum(len(kbo.rev_info) for kbo in self.kbo_list)
+        done = 0
+        self.__progress('templates', 0, valid_rev_count)
+        for kbo in self.kbo_list:
+            self.__check_cancel()
+            for revo in kbo.rev_info:
+                if self.__fast:
+                    revo.scanned = False
+                else:
+                    self.__find_layout_names(kbo, revo)
+                done += 1
+                self.__progress('templates', done, valid_rev_count)
+
         # Processing keymaps
 
-        for km_path in keymaplist:
+        self.__progress('keymaps', 0, len(keymaplist))
+        for done, km_path in enumerate(keymaplist, 1):
+            self.__progress('keymaps', done, len(keymaplist))
             # info list = [ <keyboard> / <rev> ] /keymaps/ [ <keymap> ]
             keymap_sep = os.sep+'keymaps'+os.sep
             info_list = km_path.split(keymap_sep)
@@ -928,11 +2084,48 @@ class _Cache:
         # After collecting all information, dump KBInfo list to text file for faster processing in future
 
         if self.kbo_list:
+            self.__progress('save')
             self.__save_cache()
+            self.__progress('done')
             proc_msg = ' '.join(['Processed', str(total_kb_count), ' keyboards with', str(valid_kb_count), 'validated for conversion'])
-            self.__console.note(['New cache_kb.yaml successfully generated', 'Location: '+ self.__loc, proc_msg])
+            if self.__fast:
+                proc_msg = ' '.join(['Processed', str(total_kb_count), 'keyboards (fast scan - keyboards are validated when first used)'])
+            timings = ', '.join([phase+' '+'{:.2f}'.format(secs)+'s' for phase, secs in self.__timings.items()])
+            reads = ' '.join(['Read', str(self.__memo_stats['reads']), 'rules.mk and layout headers,', str(self.__memo_stats['saved']), 'repeated reads saved'])
+            self.__console.note(['New cache_kb.yaml successfully generated', 'Location: '+ self.__loc, proc_msg, 'Phase timings: '+timings, reads])
         else:
+            self.__progress('done')
             self.__console.warning(['No keyboard information found', 'Check QMK directory location in pref.yaml : '+self.__qmk])
+        self.__memo = {}
+
+    def __progress(self, phase, done=0, total=0):
+        """ Track per-phase timing and report progress to the progress callback (at most every 0.1s within a phase)"""
+
+        now = time.perf_counter()
+        force = False
+        if phase != self.__phase:
+            if self.__phase:
+                self.__timings[self.__phase] = now - self.__phase_start
+            self.__phase = phase
+            self.__phase_start = now
+            force = True
+
+        if not self.__on_progress:
+            return
+        if not force and now - self.__last_report < 0.1 and not (total and done == total):
+            return
+        self.__last_report = now
+
+        elapsed = now - self.__phase_start
+        eta = None
+        if total and done:
+            eta = elapsed / done * (total - done)
+        self.__on_progress(CacheProgress(phase, done, total, elapsed, eta, dict(self.__timings)))
+
+    def __check_cancel(self):
+        """ Stop cache generation if cancellation has been requested"""
+        if self.__cancel and self.__cancel.is_set():
+            raise Q2KCancelled('Cache generation cancelled')
 
     # Finding layout template names
 
@@ -960,18 +2153,12 @@ class _Cache:
         for kbl in reversed(folders):
             kb_h = os.path.split(kbl)[-1]+'.h'
             path = os.path.join(qdir, kbl, kb_h)
-            try:
-                # Open config.h file, if it exists
-                with open(path, 'r', encoding='utf8') as f:
-                    data = str(f.read())
-            except FileNotFoundError:
+            # Parse it for LAYOUT/KEYMAP macro templates
+            names = self.__memo_read('layouts', path)
+            if names is None:
                 #self.__console.warning(['Layout header not found in '+path, 'Trying a different path...'])
                 continue
-
-            # Parse it for LAYOUT/KEYMAP macro templates
-            token_list = _ParseTxt.layout_headers(data)
-            for tokens in token_list:
-                revo.template_list.append(tokens[0].name)
+            revo.template_list = revo.template_list + names
 
             # If LAYOUT/KEYMAP templates found, break from loop
             # Note: This means that some layouts will be missed.
@@ -985,11 +2172,32 @@ class _Cache:
 
         if not found:
             if revo.is_rev:
-                self.__console.warning(['Layout templates not found for '+ os.path.join(kbo.name, rev_n)])
+                self.__messages.warning(['Layout templates not found for '+ os.path.join(kbo.name, rev_n)])
             else:
-                self.__console.warning(['Layout templates not found for '+ kbo.name])
+                self.__messages.warning(['Layout templates not found for '+ kbo.name])
             revo.template_loc = 'n/a'
 
+    def __memo_read(self, kind, path):
+        """ Read and parse a rules.mk ('mcu' - list of MCUs) or <keyboard>.h ('layouts' - list of template names) at most
+        once per cache build or keyboard scan. Returns None if the file is missing (or an empty rules.mk)
+        """
+
+        key = (kind, path)
+        if key in self.__memo:
+            self.__memo_stats['saved'] += 1
+            return self.__memo[key]
+        self.__memo_stats['reads'] += 1
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                if kind == 'mcu':
+                    result = _ParseTxt.rules_mk_mcu_lines(f) if os.fstat(f.fileno()).st_size else None
+                else:
+                    result = [tokens[0].name for tokens in _ParseTxt.layout_headers(str(f.read()))]
+        except FileNotFoundError:
+            result = None
+        self.__memo[key] = result
+        return result
+
     def __find_validate_mcu(self, kbo, revo):
         """ Find and populate list of possible mcus from QMK rules.mk file"""
 
@@ -1010,20 +2218,11 @@ class _Cache:
         for kbl in reversed(folders):
             rules_mk = 'rules.mk'
             path = os.path.join(qdir, kbl, rules_mk)
-            mcu_list = []
-            try:
-                with open(path, 'r', encoding='utf8') as f:
-                    data = str(f.read())
-            except FileNotFoundError:
+            mcu_list = self.__memo_read('mcu', path)
+            if mcu_list is None:
                 #self.console.warning(['Rules.mk not found in '+path, 'Trying a different path...'])
                 continue
-
-            if not data:
-                continue
-
-            token_list = _ParseTxt.rules_mk_mcu(data)
-            for tokens in token_list:
-                mcu_list.append(tokens[0].mcu)
+            mcu_list = list(mcu_list)
 
             if mcu_list:
                 valid_mcu = self.__validate_mcu(mcu_list, kbo, revo)
@@ -1035,9 +2234,9 @@ class _Cache:
                 break
 
         if revo.is_rev:
-            self.__console.warning(['MCU information not found for '+os.path.join(kbo.name, rev_n)])
+            self.__messages.warning(['MCU information not found for '+os.path.join(kbo.name, rev_n)])
         else:
-            self.__console.warning(['MCU information not found for '+kbo.name])
+            self.__messages.warning(['MCU information not found for '+kbo.name])
         return True
 
     def __validate_mcu(self, mcu_list, kbo, revo):
@@ -1062,7 +2261,7 @@ class _Cache:
             else:
                 mcu_err_out = ' '.join([kb_n, 'might have invalid mcu', ', '.join(bad_mcu)])
 
-            self.__console.warning([mcu_err_out])
+            self.__messages.warning([mcu_err_out])
             return True
 
         else:
@@ -1071,7 +2270,7 @@ class _Cache:
             else:
                 mcu_err_out = ' '.join([kb_n, 'has invalid mcu', ', '.join(bad_mcu)])
 
-            self.__console.error([mcu_err_out], fatal=False)
+            self.__messages.error([mcu_err_out], fatal=False)
             return False
 
     def __save_cache(self):
@@ -1083,17 +2282,35 @@ class _Cache:
             except OSError as error:
                 if error.errno != errno.EEXIST and os.path.isdir(path):
                     raise
+        cache = {'schema': _Cache.SCHEMA, 'q2k': Defaults.VERSION, 'keyboards': self.kbo_list}
         try:
-            with open(self.__loc, 'w') as f:
-                yaml.dump(self.kbo_list, f)
+            with _FileLock(self.__loc):
+                _write_atomic(self.__loc, lambda f: yaml.dump(cache, f))
         except:
-            self.__console.error(['Failed to create '+self.__loc])
+            self.__messages.error(['Failed to create '+self.__loc])
+
+    def complete(kbo_list):
+        """ Give cached KBInfo and RevInfo objects any attributes they are missing (i.e. added since they were cached) with default values"""
+
+        kb_defaults, rev_defaults = vars(KBInfo()), vars(RevInfo())
+        for kbo in kbo_list:
+            for name, value in kb_defaults.items():
+                if name not in vars(kbo):
+                    setattr(kbo, name, copy.deepcopy(value))
+            for revo in kbo.rev_info:
+                for name, value in rev_defaults.items():
+                    if name not in vars(revo):
+                        setattr(revo, name, copy.deepcopy(value))
+        return kbo_list
 
     def _clear_cache(self):
         """ intended private method to clear cache """
-        if os.path.isfile(self.__loc):
-            os.remove(self.__loc)
+        with _FileLock(self.__loc):
+            if os.path.isfile(self.__loc):
+                os.remove(self.__loc)
         self.kbo_list = []
+        self.__dirty = False
+        self.__index = _SearchIndex(self.kbo_list)
 
     def _keyboard_list(self,):
         """ Accessor method for obtaining list of keyboard names from kb_list"""
@@ -1102,8 +2319,83 @@ class _Cache:
             kb_names.append(kbo.name)
         return kb_names
 
+    def _search(self, string, fields=None, limit=None):
+        """ Accessor method for ranked keyboard, revision, keymap and template name search results from kb_list"""
+        index = self.__index
+        if index is None:
+            index = self.__index = _SearchIndex(self.kbo_list)
+        return index.search(string, fields, limit)
+
+    def _scan(self, keyboard, messages=None):
+        """ Intended private method to validate the MCU and find the layout templates of a keyboard's unscanned revisions (fast scan caches)
+
+        Revisions with invalid MCUs are removed, as is the keyboard if none are left. Returns True if anything was scanned
+
+        Args:
+            messages: Console (or _MessageLog) for scan messages - default is the cache's console
+        """
+        with self.__scan_lock:
+            for kbo in self.kbo_list:
+                if kbo.name == keyboard:
+                    break
+            else:
+                return False
+            unscanned = [revo for revo in kbo.rev_info if not revo.scanned]
+            if not unscanned:
+                return False
+            self.__memo = {}
+            self.__messages = messages or self.__console
+            try:
+                removed = []
+                for revo in unscanned:
+                    if self.__find_validate_mcu(kbo, revo):
+                        self.__find_layout_names(kbo, revo)
+                        revo.scanned = True
+                    else:
+                        removed.append(revo)
+            finally:
+                self.__memo = {}
+                self.__messages = self.__console
+            if removed:
+                kbo.rev_info = [revo for revo in kbo.rev_info if revo not in removed]
+                kbo.rev_list = [rev_n for rev_n in kbo.rev_list if rev_n not in [revo.name for revo in removed]]
+            if not kbo.rev_info:
+                self.kbo_list = [other for other in self.kbo_list if other is not kbo]
+            self.__dirty = True
+            self.__index = None
+            return True
+
+    def _scan_all(self):
+        """ Intended private method to scan every unscanned keyboard, then save the cache (i.e. in a background thread)
+
+        Messages go to scan_log instead of the console, which may be in use by a conversion
+        """
+        for keyboard in self._keyboard_list():
+            if self.__stopped.is_set():
+                return
+            self._scan(keyboard, self.scan_log)
+        self._flush(self.scan_log)
+
+    def _flush(self, messages=None):
+        """ Intended private method to save revisions scanned since the cache was last saved"""
+        with self.__scan_lock:
+            if self.__dirty and not self.__stopped.is_set():
+                self.__messages = messages or self.__console
+                try:
+                    self.__save_cache()
+                finally:
+                    self.__messages = self.__console
+                self.__dirty = False
+
+    def _stop(self):
+        """ Intended private method to stop scanning and saving this cache (it is being replaced). Waits for a running scan"""
+        self.__stopped.set()
+        with self.__scan_lock:
+            pass
+
     def _keymap_list(self, keyboard, rev=''):
         """ Accessor method for obtaining list of keymaps of a particular keyboard/revision from kb_list"""
+        self._scan(keyboard)
         km_names = []
         for kbo in self.kbo_list:
             if kbo.name == keyboard:
@@ -1115,15 +2407,22 @@ class _Cache:
                 else:
                     print_rev_list = ', '.join(self._rev_list(keyboard))
                     self.__console.error(['Revision required - Valid Revisions: '+print_rev_list])
+        return km_names
 
     def _rev_list(self, keyboard):
-        """ Accessor method for obtaining list of revisions of a particular keyboard from kb_list"""
+        """ Accessor method for obtaining list of revisions of a particular keyboard from kb_list
+
+        Empty for unknown keyboards, i.e. a keyboard removed by its scan (no valid MCU) after a fast scan
+        """
+        self._scan(keyboard)
         for kbo in self.kbo_list:
             if kbo.name == keyboard:
                 return kbo.rev_list
+        return []
 
     def _template_list(self, keyboard, rev=''):
         """ Accessor method for obtaining list of templates of a particular keyboard/revision from kb_list"""
+        self._scan(keyboard)
         tp_names = []
         for kbo in self.kbo_list:
             if kbo.name == keyboard:
@@ -1135,6 +2434,113 @@ class _Cache:
                 else:
                     print_rev_list = ', '.join(self._rev_list(keyboard))
                     self.__console.error(['Revision required - Valid Revisions: '+print_rev_list])
+        return tp_names
+
+class _DepGraph:
+    """" A private class for reading and writing the dependency graph of converted keymaps (deps_kb.json in the cache folder of the QMK directory)
+
+    For each converted (keyboard, rev, keymap), the graph holds every file the conversion read, i.e. config.h files,
+    keymap.c, <keyboard>.h and all headers included by them, with the content hash each file had when that keymap was
+    converted. Paths inside the QMK directory are relative to it, in git's format.
+    """
+
+    VERSION = 2
+
+    def __init__(self, dirs):
+
+        self.__loc = os.path.join(_CacheNamespace(dirs).folder, 'deps_kb.json')
+        self.__qmk = os.path.abspath(dirs['QMK dir'])
+        self.__hashes = {}                       # Path -> content hash, computed at most once per run
+        self.outputs = {}                        # 'keyboard:rev:keymap' -> {dependency path: content hash when converted}
+        self.__recorded = set()                  # Keys recorded since the last save
+
+        self.outputs = self.__read()
+
+    def __read(self):
+        """ Read deps_kb.json - returns outputs. Graphs of an older version are dropped (keymaps are converted again)"""
+        try:
+            with open(self.__loc, 'r') as f:
+                graph = json.load(f)
+            if graph.get('version') == _DepGraph.VERSION:
+                return graph['outputs']
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+
+    def key(self, keyboard, rev, keymap):
+        return ':'.join([keyboard, rev, keymap])
+
+    def __name(self, path):
+        path = os.path.abspath(path)
+        if path.startswith(self.__qmk + os.sep):
+            return os.path.relpath(path, self.__qmk).replace(os.sep, '/')
+        return path
+
+    def __path(self, name):
+        if os.path.isabs(name):
+            return name
+        return os.path.join(self.__qmk, *name.split('/'))
+
+    def __hash(self, name):
+        if name not in self.__hashes:
+            try:
+                with open(self.__path(name), 'rb') as f:
+                    self.__hashes[name] = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                self.__hashes[name] = ''
+        return self.__hashes[name]
+
+    def record(self, keyboard, rev, keymap, paths):
+        """ Record the dependencies of a successful conversion"""
+
+        key = self.key(keyboard, rev, keymap)
+        self.outputs[key] = {name: self.__hash(name) for name in set(self.__name(path) for path in paths)}
+        self.__recorded.add(key)
+
+    def changed_files(self, ref=''):
+        """ Set of dependency paths which changed - since git revision ref of the QMK checkout, or since any keymap
+        depending on them was converted
+        """
+
+        if ref:
+            argv = ['git', '-C', self.__qmk, 'diff', '--name-only', '--no-renames', ref, '--']
+            output = subprocess.check_output(argv, stderr=subprocess.PIPE)
+            return set(output.decode('utf8').splitlines())
+        changed = set()
+        for deps in self.outputs.values():
+            changed.update(name for name, digest in deps.items() if self.__hash(name) != digest)
+        return changed
+
+    def stale_jobs(self, jobs, changed=None):
+        """ Jobs from a list of (keyboard, rev, keymap, template) jobs which were never converted, or which depend on a file
+        in changed - or, if changed is None, on a file changed since that job was converted
+        """
+
+        stale = []
+        for job in jobs:
+            deps = self.outputs.get(self.key(*job[:3]))
+            if deps is None:
+                stale.append(job)
+            elif changed is None:
+                if any(self.__hash(name) != digest for name, digest in deps.items()):
+                    stale.append(job)
+            elif changed.intersection(deps):
+                stale.append(job)
+        return stale
+
+    def save(self):
+        """ Write the graph to deps_kb.json if anything was recorded, merged with conversions saved by other processes"""
+
+        if not self.__recorded:
+            return
+        with _FileLock(self.__loc):
+            outputs = self.__read()
+            for key in self.__recorded:
+                outputs[key] = self.outputs[key]
+            graph = {'version': _DepGraph.VERSION, 'qmk': self.__qmk, 'outputs': outputs}
+            _write_atomic(self.__loc, lambda f: json.dump(graph, f, sort_keys=True))
+        self.outputs = outputs
+        self.__recorded = set()
 
 class Q2KApp:
     """" A class for the q2k application"""
@@ -1144,6 +2550,25 @@ class Q2KApp:
         self.format = self.__output[app_type]
         self.is_gui = is_gui
         self.console = _Console(is_gui)
+        self.__cancel = threading.Event()
+        self.progress = None if is_gui else self.console.progress   # Cache generation progress hook - takes CacheProgress events
+        self.timings = False                                         # Record stage timings - execute() then returns a timing report
+        self.last_timings = None                                     # Timing report of the last execute()
+        self.output_path = ''                                        # Output file of the last successful execute()
+        self.preprocessor = CompilerPreprocessor()                   # Preprocessor backend (avr-gcc)
+        self.profile_dir = ''                                        # Write a cProfile .prof file per conversion / cache build here
+        self.memory_dir = ''                                         # Write a tracemalloc top allocation report per conversion / cache build here
+        self.memory_top = 25                                         # Allocation sites listed per allocation report
+        self.profile_sample = 1.0                                    # Fraction of batch jobs to profile (0-1)
+        self.last_profile = []                                       # Files written by profiling the last execute() or cache build
+        self.last_diagnostics = []                                   # Invalid keycode records (dictionaries) of the last execute()
+        self.__rev_work = None                                       # Per-revision results shared by the keymaps of a batch (see execute_batch)
+        self.__keymap_work = None                                    # Converted keycode layers of a batch by keymap_key() (see execute_batch)
+        self.__keymap_stats = {'hits': 0, 'misses': 0}
+        self.__deps = None                                           # _DepGraph of converted keymaps (read when first needed)
+        self.fast_scan = False                                       # Generate caches with a fast scan (see scan_cache)
+        self.early_stop = True                                       # Stop preprocessing keymap.c once its keymaps[] (and fn_actions[]) are read
+        self.lib_profile = 'full'                                    # Include stub profile to preprocess with (see Defaults.LIB_PROFILES)
         # self.dirs      # directories
         # self.build_kb  # KBInfo for build
         # self.build_rev # RevInfo for build
@@ -1163,18 +2588,51 @@ class Q2KApp:
         """ Private method for reading argv input from terminal"""
         parser = argparse.ArgumentParser(description='Convert AVR C based QMK keymap and matrix files to YAML Keyplus format')
         parser.add_argument('keyboard', metavar='KEYBOARD', nargs='?', default='', help='The name of the keyboard whose keymap you wish to convert')
-        parser.add_argument('-m', '--keymap', metavar='KEYMAP', dest='keymap', default='default', help='The keymap folder to reference - default is [default]')
+        parser.add_argument('-m', '--keymap', metavar='KEYMAP', dest='keymap', default=None, help='The keymap folder to reference - default is [default] (all keymaps with --batch)')
         parser.add_argument('-t', '--template', metavar='LAYOUT', dest='template', default='', help='The layout template to reference')
         parser.add_argument('-r', '--rev', metavar='ver', dest='rev', default='', help='Revision of layout - default is n/a')
         parser.add_argument('--cache', dest='clearcache', action='store_true', help='Clear cached data (cache_kb.yaml)')
+        parser.add_argument('--fast-scan', dest='fastscan', action='store_true', help='Generate the cache from directory names only - MCUs and layouts are checked when a keyboard is first used')
         parser.add_argument('--reset', dest='clearpref', action='store_true', help='Restore preferences in pref.yaml to default')
         parser.add_argument('--debug', dest='debug', action='store_true', help='See debugging information')
         parser.add_argument('-l', '-L', '--list', dest='listkeyb', action='store_true', help='List all valid KEYBOARD inputs')
         parser.add_argument('-M', '--keymaps', dest='listkeym', action='store_true', help='List all valid KEYMAPS for the current keyboard')
         parser.add_argument('-T', '--templatelist', dest='listkeyt', action='store_true', help='List all valid LAYOUTS for the current keyboard')
         parser.add_argument('-R', '--revlist', dest='listkeyr', action='store_true', help='List all valid REVISIONS for the current keyboard')
-        parser.add_argument('-S', '--search', metavar='string', dest='searchkeyb', help='Search valid KEYBOARD inputs')
+        parser.add_argument('-S', '--search', metavar='string', dest='searchkeyb', help='Search KEYBOARD, revision, KEYMAP and LAYOUT names (ranked, typo-tolerant)')
+        parser.add_argument('-b', '--batch', dest='batch', action='store_true', help='Convert every keymap of KEYBOARD, or of every cached keyboard if no KEYBOARD is given')
+        parser.add_argument('--timings', metavar='FILE', dest='timings', nargs='?', const='-', default=None, help='Write per-stage timing report as JSON to FILE (or console if no FILE given)')
+        parser.add_argument('--no-early-stop', dest='earlystop', action='store_false', help='Preprocess whole keymap.c files, instead of stopping once keymaps[] (and fn_actions[]) have been read')
+        parser.add_argument('--lib-profile', metavar='NAME', dest='libprofile', choices=sorted(Defaults.LIB_PROFILES), default='full', help='Include stubs to preprocess with: full (default) or keymap (keymap-only stubs, also for common system headers)')
+        parser.add_argument('--preprocessor', metavar='NAME', dest='preprocessor', choices=['avr-gcc', 'cpp', 'replay'], default='avr-gcc', help='Preprocessor backend: avr-gcc (default), cpp (host preprocessor) or replay (reuse outputs within a run - outputs not seen yet still need avr-gcc)')
+        archive = parser.add_mutually_exclusive_group()
+        archive.add_argument('--record', metavar='FILE', dest='record', default='', help='Record all preprocessor outputs to a compressed archive FILE')
+        archive.add_argument('--replay', metavar='FILE', dest='replay', default='', help='Use preprocessor outputs from an archive FILE made with --record instead of running the preprocessor')
+        parser.add_argument('--profile', metavar='DIR', dest='profile', nargs='?', const='.', default='', help='Write a cProfile .prof file per conversion and cache build to DIR (default is the current directory)')
+        parser.add_argument('--trace-memory', metavar='DIR', dest='tracememory', nargs='?', const='.', default='', help='Write a top allocation report (tracemalloc) per conversion and cache build to DIR (default is the current directory)')
+        parser.add_argument('--profile-sample', metavar='FRACTION', dest='profilesample', type=float, default=1.0, help='Fraction of --batch jobs to profile - default is 1 (every job)')
+        parser.add_argument('--diagnostics', metavar='FILE', dest='diagnostics', default='', help='Write every invalid keycode occurrence to FILE as JSON Lines')
+        parser.add_argument('--format', metavar='FORMAT', dest='format', choices=['text', 'jsonl'], default='text', help='Console output format: text (default) or jsonl (one JSON object per line, no colors)')
+        parser.add_argument('--shard', metavar='INDEX/COUNT', dest='shard', type=_shard_arg, default=None, help='With --batch, convert only shard INDEX (1 to COUNT) of COUNT equal shares of the jobs')
+        parser.add_argument('--changed-since', metavar='REF', dest='changedsince', nargs='?', const='', default=None, help='With --batch, only convert keymaps whose source files changed since git revision REF of the QMK checkout (or since they were last converted if no REF given), or which were never converted')
+        parser.add_argument('--report', metavar='FILE', dest='report', default='', help='With --batch, write a JSON report with results and an output manifest to FILE (see merge-reports)')
         self.__args = parser.parse_args()
+        self.console.format = self.__args.format
+        self.fast_scan = self.__args.fastscan
+        self.early_stop = self.__args.earlystop
+        self.lib_profile = self.__args.libprofile
+        self.timings = self.__args.timings is not None
+        self.profile_dir = self.__args.profile
+        self.memory_dir = self.__args.tracememory
+        self.profile_sample = self.__args.profilesample
+        self.preprocessor = Preprocessor.named(self.__args.preprocessor)
+        if self.__args.record:
+            self.preprocessor = ReplayPreprocessor(fallback=self.preprocessor)
+        elif self.__args.replay:
+            try:
+                self.preprocessor = ReplayPreprocessor.load(self.__args.replay)
+            except (OSError, ValueError) as error:
+                self.console.error(['Failed to read preprocessor archive '+self.__args.replay, str(error)])
 
     def __set_dirs(self):
         """ Private method for initializing directories from saved pref.yaml or creating them from the Q2KDefaults constants class"""
@@ -1185,22 +2643,16 @@ class Q2KApp:
             try:
                 pref_yaml = os.path.join(Defaults.SRC, 'pref.yaml')
                 with open(pref_yaml, 'r') as f:
-                    self.dirs = yaml.load(f)
+                    self.dirs = yaml.load(f, Loader=yaml.Loader)
 
                     try:
-                        # Check version, clear cache if versions do not match.
+                        # Check version, regenerate preferences if versions do not match. Caches are upgraded by _Cache
                         if self.dirs['version'] != Defaults.VERSION:
-                            old_cache = self.dirs['Cache']
-                            if os.path.isfile(old_cache):
-                                os.remove(old_cache)
                             self.__generate_dirs()
                         else:
                             self.console.note([Defaults.PRINT_LINES, 'Using preferences from '+pref_yaml, '--reset to reset to defaults'])
                     # pref.yaml before version 1.1
                     except KeyError:
-                        old_cache = self.dirs['Cache']
-                        if os.path.isfile(old_cache):
-                            os.remove(old_cache)
                         self.__generate_dirs()
 
             except FileNotFoundError:
@@ -1221,32 +2673,77 @@ class Q2KApp:
             'Cache'                  : Defaults.CACHE,
         }
         self.dirs = dirs
+
+        pref_yaml = os.path.join(Defaults.SRC, 'pref.yaml')
         try:
-            pref_yaml = os.path.join(Defaults.SRC, 'pref.yaml')
-            with open(pref_yaml, 'w') as f:
-                f.write('# Q2K Folder Locations\n')
-                yaml.dump(dirs, f, default_flow_style=False)
-                self.console.note([Defaults.PRINT_LINES, 'New pref.yaml generated @ '+pref_yaml])
+            self.save_dirs()
+            self.console.note([Defaults.PRINT_LINES, 'New pref.yaml generated @ '+pref_yaml])
 
-        except FileNotFoundError:
+        except OSError:
             self.console.error(['Failed to generate '+pref_yaml])
 
+    def save_dirs(self):
+        """ Save the directory settings (dirs) to pref.yaml, under a _FileLock and replaced atomically. Raises OSError on failure"""
+
+        def write(f):
+            f.write('# Q2K Folder Locations\n')
+            yaml.dump(self.dirs, f, default_flow_style=False)
+
+        pref_yaml = os.path.join(Defaults.SRC, 'pref.yaml')
+        with _FileLock(pref_yaml):
+            _write_atomic(pref_yaml, write)
+
     def __pop_cache_list(self):
         """ Private method for generating or finding a cached list of KBInfo Objects """
-        self.__cache = _Cache(self.dirs, self.console, self.__args.clearcache)
+        self.__cache = self.__profile('cache', lambda: _Cache(self.dirs, self.console, self.__args.clearcache, self.__cancel, self.progress, self.fast_scan))
+
+    def __profile(self, name, func):
+        """ Private method running func() under cProfile/tracemalloc if profiling is enabled"""
+
+        profiler = _Profiler(self.profile_dir, self.memory_dir, self.memory_top)
+        self.last_profile = []
+        if not profiler.enabled():
+            return func()
+        files = []
+        try:
+            return profiler.run(name, func, files)[0]
+        finally:
+            self.last_profile = files
+            if not self.console.batch:
+                for path in files:
+                    self.console.note(['Profile written to '+path])
+
+    def __profile_name(self):
+        """ Private method for naming profiles of the current build - <keyboard>_<rev>_<keymap>"""
+
+        name = [self.build_kb.name.replace('/', '_').replace('\\', '_')]
+        if self.build_kb.build_rev:
+            name.append(self.build_kb.build_rev)
+        name.append(self.build_kb.build_keymap)
+        return '_'.join(name)
+
+    def __check_cancel(self):
+        """ Private method for stopping a conversion between stages if cancellation has been requested"""
+        if self.__cancel.is_set():
+            self.console.clear()
+            raise Q2KCancelled('Conversion cancelled')
 
     def __check_args(self):
         """ Private method for parsing arguments from terminal"""
 
+        if (self.__args.shard or self.__args.report or self.__args.changedsince is not None) and not self.__args.batch and not self.is_gui:
+            self.console.error(['--shard, --report and --changed-since require --batch'])
         if self.__args.listkeyb and not self.is_gui:
             print_kb_list = '[ '+', '.join(self.keyboard_list())+' ]'
             self.console.note(['Listing keyboards...', print_kb_list])
             exit()
         elif self.__args.listkeyr and not self.is_gui:
+            self.__check_keyboard(self.__args.keyboard)
             print_rev_list = '[ '+', '.join(self.rev_list(self.__args.keyboard))+' ]'
             self.console.note(['Listing revisions for '+self.__args.keyboard+'...', print_rev_list])
             exit()
         elif self.__args.listkeym and not self.is_gui:
+            self.__check_keyboard(self.__args.keyboard)
             print_km_list = '[ '+', '.join(self.keymap_list(self.__args.keyboard, self.__args.rev))+' ]'
             if self.__args.rev == '':
                 self.console.note(['Listing keymaps for '+self.__args.keyboard+'...', print_km_list])
@@ -1254,22 +2751,137 @@ class Q2KApp:
                 self.console.note(['Listing keymaps for '+self.__args.keyboard+ os.sep +self.__args.rev+'...', print_km_list])
             exit()
         elif self.__args.listkeyt and not self.is_gui:
+            self.__check_keyboard(self.__args.keyboard)
             print_temp_list = '[ '+', '.join(self.template_list(self.__args.keyboard, self.__args.rev))+' ]'
             if self.__args.rev == '':
                 self.console.note(['Listing layout templates for '+self.__args.keyboard+'...', print_temp_list])
             else:
                 self.console.note(['Listing layout templates for '+self.__args.keyboard+ os.sep +self.__args.rev+'...', print_temp_list])
             exit()
+        elif self.__args.batch and not self.is_gui:
+            self.__run_batch()
+            exit()
         elif self.__args.searchkeyb and not self.is_gui:
-            print_search_list = '[ '+', '.join(self.search_keyboard_list(self.__args.searchkeyb))+' ]'
+            search_list = []
+            for result in self.search(self.__args.searchkeyb, limit=50):
+                if result.field == 'keyboard':
+                    search_list.append(result.keyboard)
+                elif result.rev:
+                    search_list.append(''.join([result.keyboard, os.sep, result.rev, ' (', result.field, ': ', result.value, ')']))
+                else:
+                    search_list.append(''.join([result.keyboard, ' (', result.field, ': ', result.value, ')']))
+            print_search_list = '[ '+', '.join(search_list)+' ]'
             self.console.note(['Searching for '+self.__args.searchkeyb+'...', print_search_list])
             exit()
 
-        self.set_kb(self.__args.keyboard, self.__args.rev, self.__args.keymap, self.__args.template)
+        keymap = self.__args.keymap if self.__args.keymap is not None else 'default'
+        self.set_kb(self.__args.keyboard, self.__args.rev, keymap, self.__args.template)
+
+    def __check_keyboard(self, keyboard):
+        """ Private method to exit with an error if the keyboard is not in the cache (or was removed by its scan)"""
+
+        if not self.rev_list(keyboard) and keyboard not in self.keyboard_list():
+            print_kb_list = ', '.join(self.keyboard_list())
+            self.console.error(['Invalid Keyboard Name - '+keyboard, 'Valid Names: '+print_kb_list])
+
+    def __run_batch(self):
+        """ Private method for running a batch conversion from the terminal and printing its summary"""
+
+        jobs = self.batch_jobs(self.__args.keyboard, self.__args.rev, self.__args.keymap, self.__args.template)
+        total = len(jobs)
+        shard = self.__args.shard or (1, 1)
+        jobs = self.shard_jobs(jobs, *shard)
+        if self.__args.changedsince is not None:
+            try:
+                stale = self.changed_jobs(jobs, self.__args.changedsince)
+            except (OSError, subprocess.CalledProcessError) as error:
+                message = getattr(error, 'stderr', b'') or b''
+                self.console.error(['Failed to find changed files in '+self.dirs['QMK dir'], message.decode('utf8', 'replace').strip() or str(error)])
+            self.console.note([str(len(stale))+' of '+str(len(jobs))+' keymaps changed or not yet converted'])
+            jobs = stale
+        summary = self.execute_batch(jobs)
+        self.__print_batch_summary(summary)
+        if self.__args.report:
+            self.__write_report(self.batch_report(summary, shard, total))
+        if self.__args.timings is not None:
+            self.__write_timings({'aggregate': summary['timings'], 'jobs': summary['results']})
+        if self.__args.diagnostics:
+            self.__write_diagnostics(summary['diagnostics'])
+        if self.__args.record:
+            self.__save_archive()
+
+    def __print_batch_summary(self, summary):
+        """ Private method for printing the result of a batch conversion"""
+
+        if self.console.format == 'jsonl':
+            self.console.result('summary', {'jobs': summary['jobs'], 'ok': summary['ok'], 'failed': summary['failed'],
+                                            'invalid_keycodes': len(summary['diagnostics']), 'keymap_dedupe': summary['keymap_dedupe']})
+            return
+        self.console.note([Defaults.PRINT_LINES, 'Batch conversion finished',
+                           ' '.join([str(summary['ok']), 'converted,', str(summary['failed']), 'failed of', str(summary['jobs'])]),
+                           str(len(summary['diagnostics']))+' invalid keycodes',
+                           str(summary['keymap_dedupe']['hits'])+' identical keymaps reused'])
+        failed = []
+        for result in summary['results']:
+            if result['status'] != 'ok':
+                kb_n = os.path.join(result['keyboard'], result['rev']) if result['rev'] else result['keyboard']
+                failed.append(''.join([kb_n, ':', result['keymap'], ' - ', result['error']]))
+        if failed:
+            self.console.warning(['Failed conversions'] + failed)
+
+    def __write_timings(self, report):
+        """ Private method for writing a timing report as JSON to the --timings file or console"""
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if self.__args.timings == '-' and self.console.format == 'jsonl':
+            self.console.result('timings', report)
+        elif self.__args.timings == '-':
+            print(output)
+        else:
+            try:
+                with open(self.__args.timings, 'w') as f:
+                    f.write(output)
+                self.console.note(['Timing report written to '+self.__args.timings])
+            except OSError:
+                self.console.error(['Failed to write timing report to '+self.__args.timings], fatal=False)
+
+    def __write_report(self, report):
+        """ Private method for writing a batch report as JSON to the --report file"""
+
+        try:
+            with open(self.__args.report, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.console.note(['Batch report written to '+self.__args.report])
+        except OSError:
+            self.console.error(['Failed to write batch report to '+self.__args.report], fatal=False)
+
+    def __write_diagnostics(self, records):
+        """ Private method for writing diagnostic records as JSON Lines to the --diagnostics file"""
+
+        try:
+            with open(self.__args.diagnostics, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record, sort_keys=True)+'\n')
+            self.console.note([str(len(records))+' diagnostics written to '+self.__args.diagnostics])
+        except OSError:
+            self.console.error(['Failed to write diagnostics to '+self.__args.diagnostics], fatal=False)
+
+    def __save_archive(self):
+        """ Private method for writing recorded preprocessor outputs to the --record archive"""
+
+        try:
+            self.preprocessor.save(self.__args.record)
+            self.console.note(['Recorded '+str(len(self.preprocessor.records))+' preprocessor outputs to '+self.__args.record])
+        except OSError:
+            self.console.error(['Failed to write preprocessor archive to '+self.__args.record], fatal=False)
 
     def set_kb(self, keyboard='', rev='', keymap='', template=''):
         """ Sets the keyboard to be converted by the Q2KApp object. Intended hook-in method for GUIs"""
 
+        if not self.console.batch:
+            self.console.job = {'keyboard': keyboard, 'rev': rev, 'keymap': keymap, 'template': template}
+        if keyboard and self.__cache._scan(keyboard):
+            self.__cache._flush()
         kb_list = self.__cache.kbo_list
         build_kbo = ''
 
@@ -1326,10 +2938,41 @@ class Q2KApp:
     def refresh_dir(self):
         """ Refresh directory settings for this Q2KApp Object (from pref.yaml)"""
         self.__set_dirs()
-
-    def refresh_cache(self):
-        """ Refresh cached KBInfo list for this Q2KApp Object (from cache_kb.yaml)"""
-        self.__cache = _Cache(self.dirs, self.console, True)
+        self.__deps = None
+
+    def refresh_cache(self, force=True):
+        """ Refresh cached KBInfo list for this Q2KApp Object (from cache_kb.yaml)
+
+        Args:
+            force(bool): Generate a new cache - otherwise the cache of the current QMK directory is used if there is one
+        """
+        self.__deps = None
+        self.__cache._flush()
+        self.__cache._stop()
+        self.__cache = self.__profile('cache', lambda: _Cache(self.dirs, self.console, force, self.__cancel, self.progress, self.fast_scan))
+
+    def scan_cache(self, background=False):
+        """ Validate the MCUs and find the layout templates of every keyboard not yet used since a fast scan (fast_scan)
+
+        Keyboards are otherwise scanned when first used. The results are saved to the cache.
+
+        Args:
+            background(bool): Scan in a daemon thread, which is returned - it stops when the cache is refreshed
+        """
+        if not background:
+            self.__cache._scan_all()
+            return None
+        thread = threading.Thread(target=self.__cache._scan_all, name='q2k-scan', daemon=True)
+        thread.start()
+        return thread
+
+    def cancel(self):
+        """ Request that a running refresh_cache() or execute() stops early, raising Q2KCancelled. Safe to call from any thread"""
+        self.__cancel.set()
+
+    def reset_cancel(self):
+        """ Clear an earlier cancel() - call once when a job starts, so a cancel during any of its steps is kept"""
+        self.__cancel.clear()
 
     def reset(self):
         """ Reset cache and directory settings for this Q2KApp Object (force generate new settings from defaults)"""
@@ -1356,30 +2999,264 @@ class Q2KApp:
         """ get accessor method for keymaps for this keyboard revision (from cache)"""
         return self.__cache._keymap_list(keyboard, rev)
 
-    def search_keyboard_list(self, string):
-        """ get all keyboard names (from cache) which match this string"""
+    def search(self, string, fields=None, limit=None):
+        """ get ranked SearchResult objects (from cache) for keyboard, revision, keymap and template names matching this string
+
+        Args:
+            string(str)                          : Search query - case-insensitive and tolerant of typos
+            fields(:obj:`list` of :obj:`str`)    : Only search these fields (keyboard, revision, keymap, template). Default is all
+            limit(int)                           : Maximum number of results to return. Default is no limit
+        """
+        return self.__cache._search(string, fields, limit)
+
+    def search_keyboard_list(self, string, fields=None, limit=None):
+        """ get all keyboard names (from cache) which match this string, best match first"""
 
-        kb_names = self.__cache._keyboard_list()
         results = []
-        for kb in kb_names:
-            if kb.find(string) != -1:
-                results.append(kb)
+        for result in self.search(string, fields):
+            if result.keyboard not in results:
+                results.append(result.keyboard)
+                if limit and len(results) >= limit:
+                    break
         return results
 
-    def execute(self):
-        """ Execute conversion of previously selected keyboard/rev/keymap """
+    def batch_jobs(self, keyboard='', rev='', keymap=None, template=''):
+        """ get the list of (keyboard, rev, keymap, template) conversions for a batch, in a deterministic order
+
+        Args:
+            keyboard(str) : Only this keyboard. Default is every cached keyboard
+            rev(str)      : Only this revision. Default is every revision
+            keymap(str)   : Only this keymap. Default is every keymap
+            template(str) : Layout template to use where available. Default is the first template of each revision
+        """
+
+        jobs = []
+        for kb_n in sorted(self.keyboard_list()):
+            if keyboard and kb_n != keyboard:
+                continue
+            rev_list = self.rev_list(kb_n)
+            if rev_list is None:
+                continue                                      # No valid revisions (found by a fast scan cache's first use)
+            rev_list = sorted(rev_list) or ['']
+            for rev_n in rev_list:
+                if rev and rev_n != rev:
+                    continue
+                temp_list = self.template_list(kb_n, rev_n)
+                if template in temp_list:
+                    temp_n = template
+                else:
+                    temp_n = temp_list[0] if temp_list else ''
+                for km_n in sorted(set(self.keymap_list(kb_n, rev_n))):
+                    if keymap is None or km_n == keymap:
+                        jobs.append((kb_n, rev_n, km_n, temp_n))
+        self.__cache._flush()
+        return jobs
+
+    def dependency_graph(self):
+        """ get the _DepGraph of converted keymaps (from deps_kb.json in the cache folder of the QMK directory)"""
+        if self.__deps is None:
+            self.__deps = _DepGraph(self.dirs)
+        return self.__deps
+
+    def changed_jobs(self, jobs, ref=''):
+        """ get the jobs from a list of batch jobs which need converting again - jobs never converted, and jobs which
+        depend on a file changed since git revision ref of the QMK checkout (or since the job was last converted if no ref)
+
+        Raises OSError or subprocess.CalledProcessError if git fails
+        """
+        graph = self.dependency_graph()
+        return graph.stale_jobs(jobs, graph.changed_files(ref) if ref else None)
+
+    def shard_jobs(self, jobs, index, count):
+        """ get shard index (1 to count) of a list of batch jobs
+
+        Consecutive jobs of the same keyboard revision stay in one shard, so they still share per-revision results and
+        identical keymaps (see execute_batch). Each group goes to the shard with the fewest jobs so far (the lowest index
+        on ties). Shards only partition the jobs when every shard is taken from the same list, i.e. batch_jobs() of the
+        same cache
+        """
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError('Invalid shard '+str(index)+'/'+str(count))
+        groups = []
+        for job in jobs:
+            if groups and groups[-1][0][:2] == job[:2]:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        sizes = [0] * count
+        shard = []
+        for group in groups:
+            target = sizes.index(min(sizes))
+            sizes[target] += len(group)
+            if target == index-1:
+                shard += group
+        return shard
+
+    def batch_report(self, summary, shard=(1, 1), total_jobs=None):
+        """ Create a JSON serialisable report of an execute_batch() summary, for merging with merge_reports()
+
+        Args:
+            summary(dict)  : execute_batch() summary
+            shard(tuple)   : (index, count) of the shard this batch converted
+            total_jobs(int): Number of jobs in all shards. Default is the number of jobs in this batch
+        """
+
+        out_dir = self.dirs['Keyplus YAML output']
+        manifest = []
+        for result in summary['results']:
+            if result['status'] != 'ok' or not result['output']:
+                continue
+            with open(result['output'], 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            manifest.append({'keyboard': result['keyboard'], 'rev': result['rev'], 'keymap': result['keymap'],
+                             'file': os.path.relpath(result['output'], out_dir).replace(os.sep, '/'), 'sha256': digest})
+
+        report = {
+            'format'           : 'q2k-batch-report',
+            'version'          : 1,
+            'q2k'              : Defaults.VERSION,
+            'shard'            : {'index': shard[0], 'count': shard[1]},
+            'total_jobs'       : total_jobs if total_jobs is not None else summary['jobs'],
+            'jobs'             : summary['jobs'],
+            'ok'               : summary['ok'],
+            'failed'           : summary['failed'],
+            'invalid_keycodes' : len(summary['diagnostics']),
+            'keymap_dedupe'    : summary['keymap_dedupe'],
+            'results'          : summary['results'],
+            'manifest'         : manifest,
+        }
+        if 'timings' in summary:
+            report['timings'] = summary['timings']
+        return report
+
+    def execute_batch(self, jobs=None):
+        """ Execute conversion of a list of (keyboard, rev, keymap, template) jobs, carrying on past failed conversions
+
+        Matrix data (config.h) and layout templates (<keyboard>.h) are only read once for consecutive jobs of the same
+        keyboard revision - keep jobs ordered by keyboard and revision, as batch_jobs() does. Keymaps identical to an
+        earlier keymap of the batch (same source and included headers) reuse its converted keycode layers.
+
+        Returns a summary dictionary with counts, one result per job and the diagnostic records (invalid keycodes) of
+        all jobs. If timings are enabled, the summary also holds per-stage percentiles aggregated over all jobs.
+        """
 
-        self.__cpp = _Cpp(self.build_kb, self.dirs, self.console)
+        if jobs is None:
+            jobs = self.batch_jobs()
+
+        self.console.batch = True
+        self.__rev_work = {}
+        self.__keymap_work = {}
+        self.__keymap_stats = {'hits': 0, 'misses': 0}
+        results = []
+        diagnostics = []
+        try:
+            for index, (keyboard, rev, keymap, template) in enumerate(jobs):
+                result = {'keyboard': keyboard, 'rev': rev, 'keymap': keymap, 'template': template, 'status': 'ok', 'ok': True, 'error': '',
+                          'output': ''}
+                self.__check_cancel()
+                self.last_timings = None
+                self.last_profile = []
+                try:
+                    self.set_kb(keyboard, rev, keymap, template)
+                    if _Profiler.sampled(index, self.profile_sample):
+                        report = self.__profile(self.__profile_name(), self.__execute)
+                    else:
+                        report = self.__execute()
+                    result['output'] = self.output_path
+                except Q2KCancelled:
+                    raise
+                except (RuntimeError, RuntimeWarning) as error:
+                    result['status'] = 'failed'
+                    result['ok'] = False
+                    result['error'] = str(error)
+                    report = self.last_timings
+                except Exception as error:
+                    result['status'] = 'failed'
+                    result['ok'] = False
+                    result['error'] = ''.join([type(error).__name__, ': ', str(error)])
+                    report = self.last_timings
+                if self.timings and report:
+                    result['timings'] = report
+                if self.last_profile:
+                    result['profile'] = self.last_profile
+                result['invalid_keycodes'] = len(self.last_diagnostics)
+                job = {'keyboard': keyboard, 'rev': rev, 'keymap': keymap}
+                diagnostics += [dict(job, **record) for record in self.last_diagnostics]
+                results.append(result)
+                self.console.result('result', result)
+        finally:
+            self.console.batch = False
+            self.console.clear()
+            self.__rev_work = None
+            self.__keymap_work = None
+            self.dependency_graph().save()
+
+        summary = {
+            'jobs'        : len(results),
+            'ok'          : len([result for result in results if result['status'] == 'ok']),
+            'failed'      : len([result for result in results if result['status'] != 'ok']),
+            'results'     : results,
+            'diagnostics' : diagnostics,
+            'keymap_dedupe' : dict(self.__keymap_stats),
+        }
+        if self.timings:
+            summary['timings'] = _Timings.aggregate([result['timings'] for result in results if 'timings' in result])
+        return summary
+
+    def execute(self):
+        """ Execute conversion of previously selected keyboard/rev/keymap
+
+        Returns a timing report (dictionary) if timings are enabled, otherwise None
+        """
+
+        report = self.__profile(self.__profile_name(), self.__execute)
+        self.dependency_graph().save()
+        self.console.result('result', {'keyboard': self.build_kb.name, 'rev': self.build_kb.build_rev, 'keymap': self.build_kb.build_keymap,
+                                       'template': self.build_kb.build_template, 'status': 'ok', 'ok': True, 'output': self.output_path,
+                                       'invalid_keycodes': len(self.last_diagnostics)})
+        self.console.job = None
+        if self.__args.timings is not None and not self.is_gui:
+            self.__write_timings(report)
+        if self.__args.diagnostics and not self.is_gui:
+            job = {'keyboard': self.build_kb.name, 'rev': self.build_kb.build_rev, 'keymap': self.build_kb.build_keymap}
+            self.__write_diagnostics([dict(job, **record) for record in self.last_diagnostics])
+        if self.__args.record and not self.is_gui:
+            self.__save_archive()
+        return report
+
+    def __execute(self):
+        """ Private method running each conversion stage of the current build, with timing"""
+
+        self.__timings = _Timings()
+        self.last_timings = None
+        self.last_diagnostics = []
+        self.output_path = ''
+        self.__cpp = _Cpp(self.build_kb, self.dirs, self.console, self.__timings, self.preprocessor, self.early_stop, self.lib_profile)
 
         self.console.clear()            # Clear console
-        self.__check_mcu()              # Check for MCU and Matrix Pins
-        self.__get_config_header()
-        self.__get_keycodes()           # Init Layout + Templates
-        self.__get_templates()
-        self.__merge_layout_template()  # Process Layout + Templates
-        self.__convert_matrix_map()
-        self.__create_output()          # Pipe output to yaml or json
+        stages = [
+            ('check_mcu', self.__check_mcu),                         # Check for MCU and Matrix Pins
+            ('get_config_header', self.__get_config_header),
+            ('get_keycodes', self.__get_keycodes),                   # Init Layout + Templates
+            ('get_templates', self.__get_templates),
+            ('merge_layout_template', self.__merge_layout_template), # Process Layout + Templates
+            ('convert_matrix_map', self.__convert_matrix_map),
+            ('create_output', self.__create_output),                 # Pipe output to yaml or json
+        ]
+        try:
+            for name, stage in stages:
+                self.__check_cancel()
+                self.__timings.stage(name, stage)
+            dependencies = set(self.__cpp.dependencies)
+            if self.build_rev.template_list:
+                dependencies.add(self.build_rev.template_loc)
+            self.dependency_graph().record(self.build_kb.name, self.build_kb.build_rev, self.build_kb.build_keymap, dependencies)
+        finally:
+            if self.timings:
+                self.last_timings = self.__timings.report()
+            self.last_diagnostics = [diagnostic.as_dict() for diagnostic in self.console.diagnostics]
         self.console.clear()            # Clear console
+        return self.last_timings
 
     def __check_mcu(self):
         """ Check MCU type for the current build"""
@@ -1403,9 +3280,44 @@ class Q2KApp:
 
         self.console.note(['No MCU incompatibility detected'])
 
+    def __reuse_rev_work(self, name, func):
+        """ Private method running func() for the current build, or reusing its result from an earlier keymap of this revision
+
+        Only used in batch conversions, where jobs are ordered by keyboard and revision. func() returns a result which
+        does not depend on the keymap. Errors and warnings it recorded, and files it preprocessed, are recorded again
+        when the result is reused.
+        Only the results of the current revision are kept.
+        """
+
+        if self.__rev_work is None:
+            return func()
+        key = (self.build_kb.name, self.build_rev.name)
+        if self.__rev_work.get('revision') != key:
+            self.__rev_work = {'revision': key}
+        if name in self.__rev_work:
+            result, errors, dependencies = self.__rev_work[name]
+            self.console.errors += errors
+            self.__cpp.dependencies |= dependencies
+            self.__timings.count('revision_reuse')
+            return result
+        before = len(self.console.errors)
+        before_deps = set(self.__cpp.dependencies)
+        result = func()
+        self.__rev_work[name] = (result, self.console.errors[before:], self.__cpp.dependencies - before_deps)
+        return result
+
     def __get_config_header(self):
         """ Get matrix data from config.h file for the current build"""
 
+        revo = self.build_rev
+        row_pins, col_pins, diodes = self.__reuse_rev_work('config_header', self.__find_config_header)
+        revo.build_m_row_pins = row_pins
+        revo.build_m_col_pins = col_pins
+        revo.build_diodes = diodes
+
+    def __find_config_header(self):
+        """ Find matrix data in config.h files for the current build - returns (row pins, col pins, diode direction)"""
+
         rev = self.build_rev.name
         revo = self.build_rev
         kblibs = list(self.build_kb.libs)
@@ -1427,31 +3339,61 @@ class Q2KApp:
 
             if not data:
                 continue
+            self.__timings.count('config_headers')
+            self.__timings.count('config_chars', len(data))
 
             matrix_data = _ParseTxt.config_headers(data)
             if matrix_data:
-                revo.build_m_row_pins = matrix_data[0]
-                revo.build_m_col_pins = matrix_data[1]
+                diodes = 'none'
                 if len(matrix_data) > 2:
-                    revo.build_diodes = matrix_data[2]
+                    diodes = matrix_data[2]
 
                 self.console.note(['Matrix pinout data found @ '+path])
-                if revo.build_diodes == 'none':
+                if diodes == 'none':
                     self.console.warning(['Matrix diode direction not found.'], pause=True)
                 else:
-                    self.console.note(['Matrix diode direction is: '+revo.build_diodes])
-                return
+                    self.console.note(['Matrix diode direction is: '+diodes])
+                return matrix_data[0], matrix_data[1], diodes
             else:
                 continue
 
         self.console.warning(['Config.h header not found for '+self.build_kb.name, 'Matrix row/col pins must be provided manually!'], pause=True)
-        return
+        return [], [], 'none'
 
     def __get_keycodes(self, debug=False):
-        """ Get keycodes from the keymap.c file for the current build"""
+        """ Get keycodes from the keymap.c file for the current build, reusing the result of an identical keymap in a batch"""
+
+        key = self.__cpp.keymap_key() if self.__keymap_work is not None else ''
+        if key and key in self.__keymap_work:
+            layers, diagnostics, errors, dependencies = self.__keymap_work[key]
+            self.__cpp.record_keymap()
+            self.build_rev.build_layout = copy.deepcopy(layers)
+            self.console.errors += errors
+            self.__cpp.dependencies |= dependencies | self.__cpp.keymap_sources
+            for diagnostic in diagnostics:
+                self.console.kc_location = (diagnostic.layer, diagnostic.position)
+                self.console.bad_kc(diagnostic.kind, diagnostic.code)
+            self.console.kc_location = ('', -1)
+            self.console.summarize_bad_kc()
+            self.__keymap_stats['hits'] += 1
+            self.__timings.count('keymap_reuse')
+            self.__timings.count('invalid_keycodes', len(self.console.diagnostics))
+            return
+
+        before = len(self.console.errors)
+        before_deps = set(self.__cpp.dependencies)
+        self.__read_keycodes(debug)
+        if key:
+            self.__keymap_stats['misses'] += 1
+            self.__keymap_work[key] = (copy.deepcopy(self.build_rev.build_layout), list(self.console.diagnostics), self.console.errors[before:],
+                                       self.__cpp.dependencies - before_deps)
+
+    def __read_keycodes(self, debug=False):
+        """ Preprocess and parse the keymap.c file for the current build and convert its keycodes"""
 
         revo = self.build_rev
         data = self.__cpp.preproc_keymap()
+        self.__timings.count('keymap_chars', len(data))
         token_list = _ParseTxt.keymaps(data)
         function_token_list = _ParseTxt.keymap_functions(data)
 
@@ -1484,6 +3426,7 @@ class Q2KApp:
                 if len(row) > curr_layer.matrix_cols:
                     num_col = len(row)
                 curr_layer.keymap += (list(row))
+                self.__timings.count('keymap_tokens', len(row))
 
             curr_layer.matrix_cols = num_col
             layer_list.append(curr_layer)
@@ -1563,6 +3506,8 @@ class Q2KApp:
             self.console.error(['Parsed and found no keymap', 'Failed to parse keymap file'])
         else:
             revo.build_layout = layer_list
+        self.__timings.count('layers', len(layer_list))
+        self.__timings.count('functions', len(functions))
 
         self.__convert_keycodes(layer_names, functions)
 
@@ -1574,6 +3519,9 @@ class Q2KApp:
                 layer.convert_keyplus_keymap(layer_names, functions, self.console)
             #elif self.format == self.__output.kbfirmware:
                 #layer.convert_kbf_keymap(layer_list, self.console)
+        self.console.kc_location = ('', -1)
+        self.console.summarize_bad_kc()
+        self.__timings.count('invalid_keycodes', len(self.console.diagnostics))
 
     def __get_templates(self, debug=False):
         """ Get layout templates for the current build from <keyboard>.h"""
@@ -1581,27 +3529,7 @@ class Q2KApp:
         revo = self.build_rev
 
         if revo.template_list:
-            keyboard_h = revo.template_loc
-
-            with open(keyboard_h, 'r', encoding='utf8') as f:
-                data = str(f.read())
-
-            token_list = _ParseTxt.layout_headers(data)
-            for tokens in token_list:
-                curr_template = LayoutTemplate(tokens[0].name)
-
-                for row in tokens[0].layout:
-                    layout_row = list(row)
-                    curr_template.layout.append(layout_row)
-
-                array = list(tokens[0].array)
-                for i, element in enumerate(array):
-                    array[i] = re.sub('^[^##]*##', '', element)
-
-                curr_template.array = array
-                revo.build_templates.append(curr_template)
-            self.__convert_template_index()
-
+            revo.build_templates = list(self.__reuse_rev_work('templates', self.__parse_templates))
         else:
             self.__generate_matrix_template()
 
@@ -1614,6 +3542,33 @@ class Q2KApp:
                 print('Array')
                 print(template.array)
 
+    def __parse_templates(self):
+        """ Parse <keyboard>.h layout templates for the current build and convert them to array index format"""
+
+        revo = self.build_rev
+        keyboard_h = revo.template_loc
+
+        with open(keyboard_h, 'r', encoding='utf8') as f:
+            data = str(f.read())
+
+        token_list = _ParseTxt.layout_headers(data)
+        for tokens in token_list:
+            curr_template = LayoutTemplate(tokens[0].name)
+
+            for row in tokens[0].layout:
+                layout_row = list(row)
+                curr_template.layout.append(layout_row)
+
+            array = list(tokens[0].array)
+            for i, element in enumerate(array):
+                array[i] = re.sub('^[^##]*##', '', element)
+
+            curr_template.array = array
+            revo.build_templates.append(curr_template)
+            self.__timings.count('templates')
+        self.__convert_template_index()
+        return list(revo.build_templates)
+
     def __generate_matrix_template(self, index=0):
         """ Create a layout template based upon the keycode array in keymap.c"""
 
@@ -1716,6 +3671,7 @@ class Q2KApp:
                 layer.convert_keyplus_matrix(col_limit)
             #elif self.format == self.__output.kbfirmware:
                 #layer.convert_kbfirmware_matrix(col_limit)
+            self.__timings.count('keys', sum(len(row) for row in layer.layout))
 
             if self.__args.debug or debug:
                 self.console.note(['Layer '+layer.name])
@@ -1747,7 +3703,7 @@ class Q2KApp:
         layers = rev.build_layout
 
         errors = []
-        for error in self.console.errors:
+        for error in self.console.errors + self.console.bad_kc_lines(Defaults.BAD_KC_REPORT):
             error = ''.join(['# ', error, '\n'])
             errors.append(error)
 
@@ -1840,11 +3796,115 @@ class Q2KApp:
         if self.__args.debug or debug:
             print(output_yaml_info)
 
+        self.output_path = output_yaml
         self.console.note(['SUCCESS! Output is in: '+output_yaml])
 
 
+def _shard_arg(text):
+    """ argparse type for --shard INDEX/COUNT"""
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected INDEX/COUNT, i.e. 1/4')
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('INDEX must be between 1 and COUNT')
+    return index, count
+
+def merge_reports(reports):
+    """ Merge Q2KApp.batch_report() reports of several shards into a single report
+
+    Results and manifest entries are sorted by keyboard, revision and keymap. Shards of the same batch which are not
+    among the reports are listed in 'missing_shards', and jobs converted by more than one shard in 'duplicates'.
+    Timings are re-aggregated from per-job timings where available.
+    """
+
+    results = {}
+    manifest = {}
+    duplicates = []
+    shards = set()
+    count = 0
+    total_jobs = 0
+    for report in reports:
+        if report.get('format') != 'q2k-batch-report':
+            raise ValueError('Not a Q2K batch report')
+        shard = report['shard']
+        if count and shard['count'] != count:
+            raise ValueError('Reports are from batches with different shard counts')
+        count = shard['count']
+        shards.add(shard['index'])
+        total_jobs = max(total_jobs, report['total_jobs'])
+        for result in report['results']:
+            key = (result['keyboard'], result['rev'], result['keymap'])
+            if key in results:
+                duplicates.append(':'.join(key))
+            results[key] = result
+        for entry in report['manifest']:
+            manifest[(entry['keyboard'], entry['rev'], entry['keymap'])] = entry
+
+    results = [results[key] for key in sorted(results)]
+    merged = {
+        'format'           : 'q2k-batch-report',
+        'version'          : 1,
+        'q2k'              : Defaults.VERSION,
+        'shard'            : {'index': 1, 'count': 1},
+        'shards'           : sorted(shards),
+        'missing_shards'   : [index for index in range(1, count+1) if index not in shards],
+        'duplicates'       : duplicates,
+        'total_jobs'       : total_jobs,
+        'jobs'             : len(results),
+        'ok'               : len([result for result in results if result['status'] == 'ok']),
+        'failed'           : len([result for result in results if result['status'] != 'ok']),
+        'invalid_keycodes' : sum(result.get('invalid_keycodes', 0) for result in results),
+        'results'          : results,
+        'manifest'         : [manifest[key] for key in sorted(manifest)],
+    }
+    timings = [result['timings'] for result in results if 'timings' in result]
+    if timings:
+        merged['timings'] = _Timings.aggregate(timings)
+    return merged
+
+def merge_reports_cli(argv=None):
+    """ q2k-cli merge-reports [-o FILE] REPORT... - merge --report files of a sharded batch"""
+
+    parser = argparse.ArgumentParser(prog='q2k-cli merge-reports', description='Merge Q2K batch reports (--batch --report) of several shards')
+    parser.add_argument('reports', metavar='REPORT', nargs='+', help='Batch report files')
+    parser.add_argument('-o', '--output', metavar='FILE', dest='output', default='', help='Write the merged report to FILE (default is the console)')
+    args = parser.parse_args(argv)
+    console = _Console(False)
+
+    reports = []
+    for path in args.reports:
+        try:
+            with open(path, 'r') as f:
+                reports.append(json.load(f))
+        except (OSError, ValueError) as error:
+            console.error(['Failed to read batch report '+path, str(error)])
+    try:
+        merged = merge_reports(reports)
+    except (KeyError, ValueError) as error:
+        console.error(['Failed to merge batch reports', str(error)])
+
+    if not args.output:
+        print(json.dumps(merged, indent=2, sort_keys=True))
+        return
+    try:
+        with open(args.output, 'w') as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+    except OSError:
+        console.error(['Failed to write merged report to '+args.output])
+
+    console.note(['Merged '+str(len(reports))+' batch reports into '+args.output,
+                  ' '.join([str(merged['ok']), 'converted,', str(merged['failed']), 'failed of', str(merged['jobs']), '(total '+str(merged['total_jobs'])+')'])])
+    if merged['missing_shards'] or merged['duplicates'] or merged['jobs'] != merged['total_jobs']:
+        console.warning(['Merged reports do not cover the batch exactly',
+                         'Missing shards: '+(', '.join(str(index) for index in merged['missing_shards']) or 'none'),
+                         'Duplicate jobs: '+(', '.join(merged['duplicates']) or 'none')])
+
 def q2keyplus():
     """" Hook-in function for q2k-cli command line interface"""
+    if sys.argv[1:2] == ['merge-reports']:
+        merge_reports_cli(sys.argv[2:])
+        return
     q2k = Q2KApp('keyplus')
     q2k.execute()
 
@@ -1,24 +1,34 @@
 import q2k.core as core
 import os
 import platform
+import queue
 import sys
 import threading
 import traceback
 
-from tkinter import filedialog, Tk, E, W, LEFT, CENTER, INSERT, NORMAL, ttk, Menu, Text, scrolledtext, messagebox, Button, Entry, StringVar, LabelFrame, Label, Frame
-from tkinter.ttk import Combobox
-
-import yaml
+from tkinter import filedialog, Tk, E, W, LEFT, CENTER, INSERT, NORMAL, DISABLED, ttk, Menu, Text, scrolledtext, messagebox, Button, Entry, StringVar, LabelFrame, Label, Frame
+from tkinter.ttk import Combobox, Progressbar
 
 class ConsoleText(Text):
     """A Tkinter Text widget that provides a scrolling display of console
-    stderr and stdout."""
+    stderr and stdout.
+
+    Writes only go into a thread-safe queue, so any thread can write. The Tk
+    main loop flushes the queue into the widget in chunks every FLUSH_MS, and
+    only the last MAX_LINES lines are kept."""
+
+    FLUSH_MS   = 100    # Flush interval
+    FLUSH_MAX  = 5000   # Maximum queued writes handled per flush (the rest wait for the next flush)
+    MAX_LINES  = 2000   # Older lines are dropped beyond this
 
     class IORedirector(object):
         """A general class for redirecting I/O to this Text gcwidget."""
         def __init__(self,text_area):
             self.text_area = text_area
 
+        def flush(self):
+            pass
+
     class StdoutRedirector(IORedirector):
         """A class for redirecting stdout to this Text widget."""
         def write(self,str):
@@ -36,7 +46,7 @@ class ConsoleText(Text):
         Text.__init__(self, master, cnf, **kw)
 
         self.started = False
-        self.write_lock = threading.Lock()
+        self.pending = queue.Queue()
 
         self.tag_configure('STDOUT',background='black',foreground='white')
         self.tag_configure('STDERR',background='black',foreground='red')
@@ -44,6 +54,8 @@ class ConsoleText(Text):
         self.config(state=NORMAL)
         self.bind('<Key>',lambda e: 'break') #ignore all key presses
 
+        self.after(self.FLUSH_MS, self.flush)
+
     def start(self):
 
         if self.started:
@@ -73,12 +85,106 @@ class ConsoleText(Text):
 
     def write(self,val,is_stderr=False):
 
-        self.write_lock.acquire()
+        self.pending.put((val, 'STDERR' if is_stderr else 'STDOUT'))
 
-        self.insert('end',val,'STDERR' if is_stderr else 'STDOUT')
-        self.see('end')
+    def flush(self):
+        """Move queued writes into the widget - one insert per run of same-tag text, one scroll per flush."""
 
-        self.write_lock.release()
+        chunks = []
+        try:
+            for i in range(self.FLUSH_MAX):
+                val, tag = self.pending.get_nowait()
+                if chunks and chunks[-1][1] == tag:
+                    chunks[-1][0].append(val)
+                else:
+                    chunks.append(([val], tag))
+        except queue.Empty:
+            pass
+
+        if chunks:
+            for vals, tag in chunks:
+                self.insert('end', ''.join(vals), tag)
+
+            lines = int(self.index('end-1c').split('.')[0])
+            if lines > self.MAX_LINES:
+                self.delete('1.0', '%d.0' % (lines - self.MAX_LINES + 1))
+            self.see('end')
+
+        self.after(self.FLUSH_MS, self.flush)
+
+class Worker():
+    """Runs one long Q2K job (cache generation, conversion) on a background thread.
+
+    The Tk main loop polls the worker with after(), so the window stays responsive.
+    Results, errors and message box requests are passed back through a queue and
+    handled on the main thread."""
+
+    POLL_MS = 50
+
+    def __init__(self, window, on_progress):
+        self.window      = window
+        self.on_progress = on_progress
+        self.jobs        = queue.Queue()
+        self.thread      = None
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, job, on_done, on_error):
+        """Run job() on a worker thread, then call on_done(result) or on_error(exception) on the main thread."""
+        self.on_done  = on_done
+        self.on_error = on_error
+        self.thread   = threading.Thread(target=self.run, args=(job,), daemon=True)
+        self.thread.start()
+        self.window.after(self.POLL_MS, self.poll)
+
+    def run(self, job):
+        try:
+            self.jobs.put(('done', job()))
+        except (RuntimeError, RuntimeWarning) as e:
+            self.jobs.put(('error', e))
+        except Exception as e:
+            print(traceback.format_exc(), file=sys.stderr)
+            self.jobs.put(('error', e))
+
+    def dialog(self, kind, title, message):
+        """core._Console dialog hook - called on the worker thread, blocks until the main thread has shown the message box."""
+        if threading.current_thread() is threading.main_thread():
+            return self.show_dialog(kind, title, message)
+        answer = {}
+        shown  = threading.Event()
+        self.jobs.put(('dialog', (kind, title, message, answer, shown)))
+        shown.wait()
+        return answer.get('result')
+
+    def progress(self, event):
+        """core.Q2KApp progress hook - called on the worker thread, handled by on_progress on the main thread."""
+        self.jobs.put(('progress', event))
+
+    def show_dialog(self, kind, title, message):
+        if kind == 'error':
+            return messagebox.showerror(title, message)
+        return messagebox.askyesno(title, message)
+
+    def poll(self):
+        try:
+            while True:
+                kind, value = self.jobs.get_nowait()
+                if kind == 'dialog':
+                    dialog_kind, title, message, answer, shown = value
+                    answer['result'] = self.show_dialog(dialog_kind, title, message)
+                    shown.set()
+                elif kind == 'progress':
+                    self.on_progress(value)
+                elif kind == 'done':
+                    self.on_done(value)
+                    return
+                else:
+                    self.on_error(value)
+                    return
+        except queue.Empty:
+            pass
+        self.window.after(self.POLL_MS, self.poll)
 
 class Window():
 
@@ -93,6 +199,9 @@ class Window():
         self.output.start() # Ensure output from loading q2k gets printed to console
         self.q2k_app = core.Q2KApp('keyplus', is_gui=True)
         self.output.stop() # Stop output printing
+        self.worker = Worker(self.window, self.show_progress)
+        self.q2k_app.console.dialog = self.worker.dialog
+        self.q2k_app.progress = self.worker.progress
        # =============================================================================================================
         # Set dynamic lists and enter main loop
        # =============================================================================================================
@@ -148,6 +257,8 @@ class Window():
         qmk_dir_entry      = Entry(top_frame, textvariable=self.qmk_dir)
         # Button
         qmk_dir_btn       = Button(top_frame, text="..", command=lambda:self.set_qmk_directory())
+        self.qmk_dir_entry = qmk_dir_entry
+        self.qmk_dir_btn   = qmk_dir_btn
 
        # =============================================================================================================
         #      Keyplus Output Directory Entry
@@ -160,6 +271,8 @@ class Window():
 
         # Button
         keyplus_dir_btn   = Button(top_frame, text="..", command=lambda:self.set_keyplus_directory())
+        self.keyplus_dir_entry = keyplus_dir_entry
+        self.keyplus_dir_btn   = keyplus_dir_btn
 
         # Settings / Positioning
         qmk_lbl.grid          (row=0, column=0,   sticky=W)
@@ -200,7 +313,7 @@ class Window():
         self.template = Combobox(kb_opts, state='readonly')
         self.keymap   = Combobox(kb_opts, state='readonly')
         self.rev      = Combobox(kb_opts, state='readonly')
-        self.kb       = Combobox(kb_opts, state='readonly')
+        self.kb       = Combobox(kb_opts)                   # Editable - typing searches the keyboard list
 
         if platform.system()   == 'Linux':
             self.template['width'] = 30
@@ -216,6 +329,7 @@ class Window():
 
         self.rev.bind('<<ComboboxSelected>>', self.event_rev_selected) # Updating list triggers event rev_select
         self.kb.bind( '<<ComboboxSelected>>', self.event_kb_selected)   # Updating list triggers event kb_select
+        self.kb.bind( '<KeyRelease>', self.event_kb_search)             # Typing filters keyboard list (search-as-you-type)
 
         # Settings / Positioning
         self.kb.grid       (row=1, column=0)
@@ -233,25 +347,44 @@ class Window():
         kb_opts2 = LabelFrame(tab1, text='', bd=0, padx=15, pady=5, height=50, width=100)
         kb_opts2.grid(sticky=E+W)
        # =============================================================================================================
-        #     Buttons:  | Convert | Generate Keyboard List | Reset |
+        #     Buttons:  | Convert | Generate Keyboard List | Reset | Cancel |
        # =============================================================================================================
 
         convert_btn = Button(kb_opts2, width='10', text='Convert', command=lambda:self.btn_execute())
         gen_btn     = Button(kb_opts2, width='20', text='Generate Keyboard List', command=lambda:self.btn_generate_lists())
         reset_btn   = Button(kb_opts2, width='10', text='Reset', command=lambda:self.btn_reset())
+        cancel_btn  = Button(kb_opts2, width='10', text='Cancel', state=DISABLED, command=lambda:self.btn_cancel())
 
         convert_btn.grid(row=0, column=0, sticky=W+E)
         gen_btn.grid    (row=0, column=1, padx=5, sticky=W+E)
         reset_btn.grid  (row=0, column=2, sticky=W+E)
+        cancel_btn.grid (row=0, column=3, padx=(5, 0), sticky=W+E)
 
         if platform.system()   == 'Linux':
-            convert_btn['width']     = 16
+            convert_btn['width']     = 12
             gen_btn['width']         = 20
-            reset_btn['width']       = 16
+            reset_btn['width']       = 10
+            cancel_btn['width']      = 10
         if platform.system() == 'Windows':
-            convert_btn['width']     = 20
+            convert_btn['width']     = 14
             gen_btn['width']         = 20
-            reset_btn['width']       = 20
+            reset_btn['width']       = 12
+            cancel_btn['width']      = 12
+
+        self.convert_btn = convert_btn
+        self.gen_btn     = gen_btn
+        self.reset_btn   = reset_btn
+        self.cancel_btn  = cancel_btn
+       # =============================================================================================================
+        #     Progress: | Cache generation progress bar      |
+        #               | Phase [ done/total ] ETA           |
+       # =============================================================================================================
+        self.progress_bar = Progressbar(kb_opts2, orient='horizontal', mode='determinate')
+        self.progress_txt = StringVar()
+        progress_lbl      = Label(kb_opts2, textvariable=self.progress_txt, anchor=W)
+
+        self.progress_bar.grid(row=1, column=0, columnspan=4, pady=(5, 0), sticky=W+E)
+        progress_lbl.grid     (row=2, column=0, columnspan=4, sticky=W)
        # =============================================================================================================
         # Frame 4 - Output 
        # =============================================================================================================
@@ -266,11 +399,11 @@ class Window():
         # Text Box
         self.output = ConsoleText(console, bd=0, bg='black', fg='white')
         if platform.system()   == 'Linux':
-            self.output['height'] = 35
+            self.output['height'] = 32
             self.output['width']  = 75
             self.output['font']   = ('Consolas', '9')
         elif platform.system() == 'Windows':
-            self.output['height'] = 27
+            self.output['height'] = 24
             self.output['width']  = 65
             self.output['font']   = ('Consolas', '9')
 
@@ -310,18 +443,30 @@ class Window():
         kb_list.sort()
 
         self.kb['values'] = kb_list
+        self.scan_lists()
+
+    def scan_lists(self):
+        # With a fast scan cache (--fast-scan), check the keyboards not used yet in the background
+        if self.q2k_app.fast_scan:
+            self.q2k_app.scan_cache(background=True)
 
     def save_pref(self):
-        pref_yaml = os.path.join(core.Defaults.SRC, 'pref.yaml')
-        with open(pref_yaml, 'w') as f:
-            f.write('# Q2K Folder Locations\n')
-            yaml.dump(self.q2k_app.dirs, f, default_flow_style = False)
+        try:
+            self.q2k_app.save_dirs()
+        except OSError as e:
+            messagebox.showerror('Error', 'Failed to save pref.yaml\n'+str(e))
 
     def set_qmk_directory(self):
-        dir_select = os.path.normpath( filedialog.askdirectory() )
+        dir_select = filedialog.askdirectory()
+        if not dir_select:
+            # Dialog cancelled - keep the current directory and lists
+            return
+        dir_select = os.path.normpath(dir_select)
         self.qmk_dir.set(dir_select)
         self.q2k_app.dirs['QMK dir'] = dir_select
         self.save_pref()
+        # Load this checkout's cached lists (generated only if it has none)
+        self.run_job(lambda: self.q2k_app.refresh_cache(force=False), self.generate_lists_done)
 
     def set_keyplus_directory(self):
         dir_select = os.path.normpath( filedialog.askdirectory() )
@@ -332,21 +477,74 @@ class Window():
     def show_about(self):
         messagebox.showinfo('About', 'Q2K Keymap Utility\nv '+core.Defaults.VERSION)
 
-    def btn_generate_lists(self):
+    def set_busy(self, busy):
+        """Disable all controls (except Cancel) while a worker job runs, and restore them afterwards."""
+        state = DISABLED if busy else NORMAL
+        for widget in (self.convert_btn, self.gen_btn, self.reset_btn, self.qmk_dir_btn, self.keyplus_dir_btn,
+                       self.qmk_dir_entry, self.keyplus_dir_entry):
+            widget['state'] = state
+        for combobox in (self.rev, self.keymap, self.template):
+            combobox['state'] = DISABLED if busy else 'readonly'
+        self.kb['state'] = state
+        self.cancel_btn['state'] = NORMAL if busy else DISABLED
+
+    def show_progress(self, event):
+        """Show a core.CacheProgress event on the progress bar - determinate when the phase size is known."""
+        if event.phase == 'done':
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', value=0)
+            self.progress_txt.set('')
+            return
+        if event.total:
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', maximum=event.total, value=event.done)
+        elif str(self.progress_bar['mode']) != 'indeterminate':
+            self.progress_bar.config(mode='indeterminate')
+            self.progress_bar.start(20)
+        self.progress_txt.set(event.describe())
+
+    def run_job(self, job, on_done):
+        """Run job on the worker thread with console output redirected; on_done runs on the main thread if it succeeds."""
+        if self.worker.busy():
+            return
+        self.set_busy(True)
         self.output.start()
+        self.q2k_app.reset_cancel()
 
+        def done(result):
+            on_done(result)
+            self.output.stop()
+            self.set_busy(False)
+            self.show_progress(core.CacheProgress('done'))
+
+        def error(e):
+            print(str(e), file=sys.stderr)
+            self.output.stop()
+            self.set_busy(False)
+            self.show_progress(core.CacheProgress('done'))
+
+        self.worker.start(job, done, error)
+
+    def btn_cancel(self):
+        if self.worker.busy():
+            print('Cancelling...')
+            self.q2k_app.cancel()
+
+    def btn_generate_lists(self):
         # Get dirs from StringVars
         self.q2k_app.dirs['QMK dir'] = self.qmk_dir.get()
         self.q2k_app.dirs['Keyplus YAML output'] = self.keyplus_dir.get()
         # Save to pref.yaml
         self.save_pref()
         #self.q2k_app.refresh_dir()
-        self.q2k_app.refresh_cache()
+        self.run_job(self.q2k_app.refresh_cache, self.generate_lists_done)
 
+    def generate_lists_done(self, result=None):
         # Get KB list, sort and set combobox to this list.
         kb_list = self.q2k_app.keyboard_list()
         kb_list.sort()
         self.kb['values'] = kb_list
+        self.scan_lists()
 
         # Reset other combo boxes
         self.rev['values'] = []
@@ -359,8 +557,6 @@ class Window():
         self.keymap.set('')
         self.template.set('')
 
-        self.output.stop()
-
     def btn_reset(self):
         self.output.start()
 
@@ -399,20 +595,11 @@ class Window():
         km_n   = self.keymap.get()
         temp_n = self.template.get()
 
-        try:
-            self.output.start()
+        def job():
             self.q2k_app.set_kb(keyboard=kb_n, rev=rev_n, keymap=km_n, template=temp_n)
             self.q2k_app.execute()
-            self.output.stop()
 
-        except RuntimeError as e:
-            #print(traceback.format_exc(), file=sys.stderr)
-            print(str(e), file=sys.stderr)
-            self.output.stop()
-
-        except RuntimeWarning as e:
-            print(str(e), file=sys.stderr)
-            self.output.stop()
+        self.run_job(job, lambda result: None)
 
     def event_rev_selected(self, event=None):
 
@@ -432,6 +619,20 @@ class Window():
         else:
             self.template.set('')
 
+    def event_kb_search(self, event):
+
+        if event.keysym in ('Up', 'Down', 'Left', 'Right', 'Return', 'Escape', 'Tab', 'Home', 'End'):
+            return
+
+        query = self.kb.get()
+        if query:
+            kb_list = self.q2k_app.search_keyboard_list(query, limit=100)
+        else:
+            kb_list = self.q2k_app.keyboard_list()
+            kb_list.sort()
+
+        self.kb['values'] = kb_list
+
     def event_kb_selected(self, event):
 
         rev_list = self.q2k_app.rev_list(self.kb.get())
@@ -0,0 +1,76 @@
+""" Shared test fixtures - a synthetic QMK tree (q2k.bench.synthetic) with Q2K's directories isolated in a temporary folder """
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import q2k.core as core
+from q2k.bench.synthetic import SyntheticTree
+
+class TreeTestCase(unittest.TestCase):
+    """ A test case converting keymaps of a synthetic QMK tree, written once per test
+
+    Attributes:
+        TREE(dict)  : SyntheticTree parameters
+        workdir(str): Temporary folder holding qmk_firmware, pref.yaml, the cache and the output
+    """
+
+    TREE = {'keyboards': 3, 'revisions': 2, 'vendors': 0.0, 'keymaps': 2, 'rows': 2, 'cols': 4, 'templates': 1, 'layers': 2}
+    DEFAULTS = ['SRC', 'CACHE', 'QMK', 'KEYP', 'KBF']
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='q2k-test-')
+        self.__saved = {name: getattr(core.Defaults, name) for name in self.DEFAULTS}
+        core.Defaults.SRC = self.workdir
+        core.Defaults.CACHE = os.path.join(self.workdir, '.cache', 'cache_kb.yaml')
+        core.Defaults.QMK = os.path.join(self.workdir, 'qmk_firmware')
+        core.Defaults.KEYP = os.path.join(self.workdir, 'out')
+        core.Defaults.KBF = os.path.join(self.workdir, 'out_kbf')
+        SyntheticTree(**self.TREE).write(core.Defaults.QMK)
+
+    def tearDown(self):
+        for name, value in self.__saved.items():
+            setattr(core.Defaults, name, value)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def quiet(self):
+        """ Context manager discarding Q2K console output"""
+        return contextlib.redirect_stdout(io.StringIO())
+
+    def needs_cpp(self):
+        """ Skip the test if there is no host C preprocessor to convert keymaps with"""
+        if not shutil.which(core.Defaults.HOST_CPP):
+            self.skipTest('no host C preprocessor ('+core.Defaults.HOST_CPP+')')
+
+    def app(self, preprocessor=None, **attributes):
+        """ A Q2KApp in library mode (no command line, no dialogs) preprocessing with the host cpp. Keyword arguments
+        are set as Q2KApp attributes before the cache is loaded again
+        """
+        argv = sys.argv
+        sys.argv = argv[:1]
+        try:
+            with self.quiet():
+                app = core.Q2KApp('keyplus', is_gui=True)
+        finally:
+            sys.argv = argv
+        app.console.batch = True
+        app.preprocessor = preprocessor or core.Preprocessor.named('cpp')
+        if attributes:
+            for name, value in attributes.items():
+                setattr(app, name, value)
+            with self.quiet():
+                app.refresh_cache(force=False)
+        return app
+
+    def path(self, *names):
+        """ Path inside the synthetic qmk_firmware/keyboards folder"""
+        return os.path.join(core.Defaults.QMK, 'keyboards', *names)
+
+    def batch(self, app, jobs=None):
+        """ execute_batch() without console output"""
+        with self.quiet():
+            return app.execute_batch(jobs)
@@ -0,0 +1,61 @@
+""" Cached keyboard lists of older schemas (_Cache.MIGRATIONS) """
+
+import glob
+import os
+import unittest
+from unittest import mock
+
+import yaml
+
+import q2k.core as core
+from tests.support import TreeTestCase
+
+class CacheMigrationTest(TreeTestCase):
+
+    def cache(self, app):
+        """ Path and contents of the cache_kb.yaml of app"""
+        path, = glob.glob(os.path.join(self.workdir, '.cache', '*', 'cache_kb*.yaml'))
+        with open(path) as f:
+            return path, yaml.load(f, Loader=yaml.Loader)
+
+    def keyboards(self, app):
+        return sorted(app.keyboard_list())
+
+    def test_schema_0_upgraded(self):
+        app = self.app()
+        path, cache = self.cache(app)
+        expected = self.keyboards(app)
+        with open(path, 'w') as f:
+            yaml.dump(cache['keyboards'], f)
+
+        with self.quiet():
+            app.refresh_cache(force=False)
+        self.assertEqual(self.keyboards(app), expected)
+        self.assertEqual(self.cache(app)[1]['schema'], core._Cache.SCHEMA)
+
+    def test_unsupported_schema_regenerated(self):
+        app = self.app()
+        path, cache = self.cache(app)
+        expected = self.keyboards(app)
+        with open(path, 'w') as f:
+            yaml.dump(dict(cache, schema=core._Cache.SCHEMA + 1, keyboards=[]), f)
+
+        with self.quiet():
+            app.refresh_cache(force=False)
+        self.assertEqual(self.keyboards(app), expected)
+        self.assertEqual(self.cache(app)[1]['schema'], core._Cache.SCHEMA)
+
+    def test_failed_upgrade_save_is_fatal(self):
+        app = self.app()
+        path, cache = self.cache(app)
+        with open(path, 'w') as f:
+            yaml.dump(cache['keyboards'], f)
+
+        with self.quiet(), mock.patch.object(core, '_write_atomic', side_effect=OSError('read-only')) as write:
+            with self.assertRaises(RuntimeError):
+                app.refresh_cache(force=False)
+        # Fatal at the upgrade - not taken for an unreadable cache and generated again
+        self.assertEqual(write.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+""" Dependency graph of converted keymaps (--changed-since) """
+
+import unittest
+
+from tests.support import TreeTestCase
+
+class ChangedSinceTest(TreeTestCase):
+
+    def test_unchanged_after_batch(self):
+        self.needs_cpp()
+        app = self.app()
+        jobs = app.batch_jobs()
+        self.assertEqual(app.changed_jobs(jobs), jobs)
+        self.batch(app, jobs)
+        self.assertEqual(self.app().changed_jobs(jobs), [])
+
+    def test_header_change_after_single_conversion(self):
+        self.needs_cpp()
+        app = self.app()
+        jobs = app.batch_jobs()
+        self.batch(app, jobs)
+
+        with open(self.path('synth0', 'synth0.h'), 'a') as f:
+            f.write('/* changed */\n')
+        # Converting one keymap of synth0 must not hide the change from the others
+        app = self.app()
+        job = [job for job in jobs if job[0] == 'synth0'][0]
+        app.console.batch = False
+        with self.quiet():
+            app.set_kb(*job)
+            app.execute()
+
+        stale = self.app().changed_jobs(jobs)
+        self.assertEqual(stale, [other for other in jobs if other[0] == 'synth0' and other != job])
+
+if __name__ == '__main__':
+    unittest.main()
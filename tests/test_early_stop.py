@@ -0,0 +1,47 @@
+""" Stopping the preprocessor once keymaps[] and fn_actions[] have been read (--no-early-stop) """
+
+import os
+import unittest
+
+from tests.support import TreeTestCase
+
+FN_ACTIONS = '''
+const uint16_t PROGMEM fn_actions[] = {
+  [0] = ACTION_LAYER_MOMENTARY(_L1)
+};
+'''
+
+class EarlyStopTest(TreeTestCase):
+
+    def convert(self, job, early_stop):
+        app = self.app()
+        app.console.batch = False
+        app.early_stop = early_stop
+        with self.quiet():
+            app.set_kb(*job)
+            app.execute()
+        with open(app.output_path, 'rb') as f:
+            return f.read()
+
+    def test_fn_actions_in_header_after_keymaps(self):
+        self.needs_cpp()
+        job = self.app().batch_jobs()[0]
+        folder = self.path(job[0], job[1], 'keymaps', job[2])
+        if not os.path.isdir(folder):
+            folder = self.path(job[0], 'keymaps', job[2])
+        keymap = os.path.join(folder, 'keymap.c')
+        with open(keymap) as f:
+            source = f.read()
+        first = source.index('LAYOUT(') + len('LAYOUT(')
+        first += len(source[first:]) - len(source[first:].lstrip())
+        with open(keymap, 'w') as f:
+            f.write(source[:first] + 'KC_FN0' + source[source.index(',', first):] + '\n#include "fn.h"\n')
+        with open(os.path.join(folder, 'fn.h'), 'w') as f:
+            f.write(FN_ACTIONS)
+
+        full = self.convert(job, False)
+        self.assertIn(b' L1 ,', full)
+        self.assertEqual(self.convert(job, True), full)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+""" Caches generated from directory names only (fast_scan), scanned when a keyboard is first used """
+
+import os
+import unittest
+
+from tests.support import TreeTestCase
+
+class FastScanTest(TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(self.path('badmcu', 'keymaps', 'default'))
+        with open(self.path('badmcu', 'rules.mk'), 'w') as f:
+            f.write('MCU = STM32F303\n')
+        with open(self.path('badmcu', 'keymaps', 'default', 'keymap.c'), 'w') as f:
+            f.write('const uint16_t keymaps[][1][1] = {};\n')
+
+    def fast_app(self):
+        app = self.app()
+        app.fast_scan = True
+        with self.quiet():
+            app.refresh_cache()
+        return app
+
+    def test_invalid_mcu_removed_on_use(self):
+        app = self.fast_app()
+        self.assertIn('badmcu', app.keyboard_list())
+        with self.quiet():
+            self.assertEqual(app.rev_list('badmcu'), [])
+        self.assertNotIn('badmcu', app.keyboard_list())
+        self.assertEqual(app.keymap_list('badmcu'), [])
+        self.assertEqual(app.template_list('badmcu'), [])
+
+    def test_same_lists_as_full_scan(self):
+        full = self.app()
+        fast = self.fast_app()
+        with self.quiet():
+            for keyboard in sorted(full.keyboard_list()):
+                self.assertEqual(fast.rev_list(keyboard), full.rev_list(keyboard))
+                for rev in full.rev_list(keyboard) or ['']:
+                    self.assertEqual(fast.keymap_list(keyboard, rev), full.keymap_list(keyboard, rev))
+                    self.assertEqual(fast.template_list(keyboard, rev), full.template_list(keyboard, rev))
+            fast.scan_cache()
+        self.assertEqual(sorted(fast.keyboard_list()), sorted(full.keyboard_list()))
+
+    def test_unknown_keyboard(self):
+        app = self.app()
+        self.assertEqual(app.rev_list('nope'), [])
+        with self.quiet(), self.assertRaises(RuntimeError):
+            app.set_kb('nope')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+""" Lock files of the cache, the dependency graph and pref.yaml (_FileLock) """
+
+import glob
+import os
+import threading
+import unittest
+
+import q2k.core as core
+from tests.support import TreeTestCase
+
+class FileLockTest(TreeTestCase):
+
+    def locks(self):
+        return glob.glob(os.path.join(self.workdir, '**', '*.lock'), recursive=True)
+
+    def test_no_lock_files_left(self):
+        self.needs_cpp()
+        app = self.app()
+        self.batch(app, app.batch_jobs())
+        self.assertEqual(self.locks(), [])
+
+    def wait(self, path, entered):
+        try:
+            with core._FileLock(path, timeout=0.2):
+                entered.append(True)
+        except TimeoutError:
+            entered.append(TimeoutError)
+
+    def test_reentrant_and_exclusive(self):
+        path = os.path.join(self.workdir, 'pref.yaml')
+        entered = []
+        with core._FileLock(path):
+            with core._FileLock(path):
+                pass
+            self.assertTrue(os.path.exists(path + '.lock'))
+            other = threading.Thread(target=self.wait, args=(path, entered))
+            other.start()
+            other.join()
+            self.assertEqual(entered, [TimeoutError])
+        self.assertEqual(self.locks(), [])
+        entered.clear()
+
+        def take():
+            with core._FileLock(path, timeout=5):
+                entered.append(True)
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(entered, [True] * 4)
+        self.assertEqual(self.locks(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+""" Recording and replaying preprocessor output (--record / --replay) """
+
+import os
+import unittest
+
+import q2k.core as core
+from tests.support import TreeTestCase
+
+class ReplayTest(TreeTestCase):
+
+    def test_archive_has_reused_keymaps(self):
+        self.needs_cpp()
+        recorder = core.ReplayPreprocessor(fallback=core.Preprocessor.named('cpp'))
+        app = self.app(recorder)
+        jobs = app.batch_jobs()
+        summary = self.batch(app, jobs)
+        self.assertEqual(summary['failed'], 0)
+        self.assertGreater(summary['keymap_dedupe']['hits'], 0)
+
+        archive = os.path.join(self.workdir, 'outputs.json.gz')
+        recorder.save(archive)
+        outputs = {}
+        for result in summary['results']:
+            with open(result['output'], 'rb') as f:
+                outputs[result['output']] = f.read()
+
+        # Every job converts on its own from the archive, without a compiler
+        app = self.app(core.ReplayPreprocessor.load(archive))
+        app.console.batch = False
+        for job in jobs:
+            with self.quiet():
+                app.set_kb(*job)
+                app.execute()
+            with open(app.output_path, 'rb') as f:
+                self.assertEqual(f.read(), outputs[app.output_path], job)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+""" Batch sharding (--shard) """
+
+import unittest
+
+import q2k.core as core
+from tests.support import TreeTestCase
+
+class ShardTest(TreeTestCase):
+
+    TREE = dict(TreeTestCase.TREE, keyboards=5)
+
+    def test_shards_partition_jobs(self):
+        app = self.app()
+        jobs = app.batch_jobs()
+        for count in range(1, 5):
+            shards = [app.shard_jobs(jobs, index, count) for index in range(1, count+1)]
+            self.assertEqual(sorted(job for shard in shards for job in shard), sorted(jobs))
+            self.assertEqual(sum(len(shard) for shard in shards), len(jobs))
+
+    def test_revision_stays_in_one_shard(self):
+        app = self.app()
+        jobs = app.batch_jobs()
+        shards = [app.shard_jobs(jobs, index, 3) for index in range(1, 4)]
+        for job in jobs:
+            owners = [index for index, shard in enumerate(shards) if any(other[:2] == job[:2] for other in shard)]
+            self.assertEqual(len(owners), 1, job)
+
+    def test_merged_reports_match_single_batch(self):
+        self.needs_cpp()
+        app = self.app()
+        jobs = app.batch_jobs()
+        single = app.batch_report(self.batch(app, jobs))
+        reports = []
+        for index in (1, 2):
+            shard = app.shard_jobs(jobs, index, 3)
+            reports.append(app.batch_report(self.batch(app, shard), (index, 3), len(jobs)))
+
+        merged = core.merge_reports(reports)
+        self.assertEqual(merged['missing_shards'], [3])
+        self.assertEqual(merged['duplicates'], [])
+        self.assertEqual(merged['total_jobs'], len(jobs))
+
+        merged = core.merge_reports(reports + [app.batch_report(self.batch(app, app.shard_jobs(jobs, 3, 3)), (3, 3), len(jobs))])
+        self.assertEqual(merged['missing_shards'], [])
+        self.assertEqual((merged['jobs'], merged['ok'], merged['failed']), (single['jobs'], single['ok'], single['failed']))
+        self.assertEqual(merged['manifest'], sorted(single['manifest'], key=lambda entry: (entry['keyboard'], entry['rev'], entry['keymap'])))
+
+        with self.assertRaises(ValueError):
+            core.merge_reports(reports + [single])
+
+    def test_invalid_shard(self):
+        app = self.app()
+        with self.assertRaises(ValueError):
+            app.shard_jobs(app.batch_jobs(), 4, 3)
+
+if __name__ == '__main__':
+    unittest.main()